@@ -0,0 +1,95 @@
+'''Compare ways of parsing ERDDAP info csvs into metadata.
+
+Run with `python benchmarks/bench_info_parsing.py [number of datasets]`.
+
+The synthetic info tables have the same columns as
+`{server}/info/{dataset_id}/index.csv` and about as many rows as an
+IOOS sensor dataset.
+'''
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+from search.utils import parse_info, parse_infos
+
+
+COLUMNS = ['geospatial_lat_min', 'geospatial_lat_max', 
+           'geospatial_lon_min', 'geospatial_lon_max', 
+           'time_coverage_start', 'time_coverage_end',
+           'defaultDataQuery', 'subsetVariables',
+           'keywords', 'id', 'infoUrl', 'institution', 'featureType', 'source', 'sourceUrl']
+
+
+def make_info(dataset_id, rng, n_variables=20, n_attributes=8):
+    '''Synthetic info table for one dataset.'''
+
+    rows = [['attribute', 'NC_GLOBAL', 'geospatial_lat_min', 'double', str(rng.uniform(-90, 0))],
+            ['attribute', 'NC_GLOBAL', 'geospatial_lat_max', 'double', str(rng.uniform(0, 90))],
+            ['attribute', 'NC_GLOBAL', 'geospatial_lon_min', 'double', str(rng.uniform(-180, 0))],
+            ['attribute', 'NC_GLOBAL', 'geospatial_lon_max', 'double', str(rng.uniform(0, 180))],
+            ['attribute', 'NC_GLOBAL', 'time_coverage_start', 'String', '2019-01-01T00:00:00Z'],
+            ['attribute', 'NC_GLOBAL', 'time_coverage_end', 'String', '2021-01-01T00:00:00Z'],
+            ['attribute', 'NC_GLOBAL', 'id', 'String', dataset_id],
+            ['attribute', 'NC_GLOBAL', 'infoUrl', 'String', f'https://example.com/{dataset_id}'],
+            ['attribute', 'NC_GLOBAL', 'institution', 'String', 'Institution'],
+            ['attribute', 'NC_GLOBAL', 'featureType', 'String', 'TimeSeries'],
+            ['attribute', 'NC_GLOBAL', 'keywords', 'String', 'a, b, c'],
+            ['attribute', 'NC_GLOBAL', 'sourceUrl', 'String', '(local files)']]
+    for i in range(n_variables):
+        rows.append(['variable', f'var{i}', '', 'float', ''])
+        for j in range(n_attributes):
+            rows.append(['attribute', f'var{i}', f'attr{j}', 'String', 'value'])
+
+    return pd.DataFrame(rows, columns=['Row Type', 'Variable Name', 'Attribute Name', 'Data Type', 'Value'])
+
+
+def parse_info_loop(info, columns):
+    '''How metadata was parsed before, with a scan of `info` per lookup.'''
+
+    items = []
+    for col in columns:
+        try:
+            item = info[info['Attribute Name'] == col]['Value'].values[0]
+            dtype = info[info['Attribute Name'] == col]['Data Type'].values[0]
+        except:
+            dtype = 'String'
+            item = 'grid' if col == 'featureType' else 'NA'
+        if dtype == 'double':
+            item = float(item)
+        elif dtype == 'int':
+            item = int(item)
+        items.append(item)
+    return items
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+
+    n_datasets = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+
+    rng = np.random.default_rng(0)
+    infos = {f'dataset_{i}': make_info(f'dataset_{i}', rng) for i in range(n_datasets)}
+
+    # make sure they agree before timing
+    loop = pd.DataFrame([parse_info_loop(info, COLUMNS) for info in infos.values()], 
+                        index=list(infos.keys()), columns=COLUMNS)
+    batch = parse_infos(infos, COLUMNS)
+    assert (loop.astype(str) == batch.astype(str)).all().all()
+
+    results = {'loop per dataset (before)': 
+                   timeit(lambda: [parse_info_loop(info, COLUMNS) for info in infos.values()]),
+               'parse_info per dataset': 
+                   timeit(lambda: [parse_info(info, COLUMNS) for info in infos.values()]),
+               'parse_infos batched': 
+                   timeit(parse_infos, infos, COLUMNS)}
+
+    base = results['loop per dataset (before)']
+    print(f'{n_datasets} info tables')
+    for name, seconds in results.items():
+        print(f'{name:>28}: {seconds:8.3f} s  ({base/seconds:5.1f}x)')
@@ -0,0 +1,93 @@
+'''Compare reading tabledap responses as csvp, nc, and parquet.
+
+Run with `python benchmarks/bench_tabledap_formats.py [number of rows]`.
+
+The synthetic responses look like an IOOS sensor timeseries with a few
+variables, written the way ERDDAP writes each format.
+'''
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+import xarray as xr
+from search.utils import frame_from_nc, frame_from_parquet
+from search.transport import read_csv_text
+
+
+UNITS = {'time': 'seconds since 1970-01-01T00:00:00Z', 'longitude': 'degrees_east',
+         'latitude': 'degrees_north', 'sea_water_temperature': 'degree_C',
+         'sea_water_practical_salinity': '1e-3', 'sea_surface_height': 'm'}
+
+
+def make_table(n, rng):
+    '''Synthetic tabledap table with `n` rows.'''
+
+    times = pd.date_range('2019-01-01', periods=n, freq='6min')
+    seconds = (times - pd.Timestamp('1970-01-01'))//pd.Timedelta('1s')
+    return pd.DataFrame({'time': seconds.astype('float64'),
+                         'longitude': np.full(n, -94.8),
+                         'latitude': np.full(n, 29.3),
+                         'station': ['urn:ioos:station:wmo:8771341']*n,
+                         'sea_water_temperature': rng.normal(20, 5, n).astype('float32'),
+                         'sea_water_practical_salinity': rng.normal(30, 2, n).astype('float32'),
+                         'sea_surface_height': rng.normal(0, 1, n).astype('float32')})
+
+
+def to_csvp(table):
+
+    df = table.copy()
+    df['time'] = pd.to_datetime(df['time'], unit='s').dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    names = {col: f'{col} ({UNITS[col]})' if col in UNITS else col for col in df.columns}
+    names['time'] = 'time (UTC)'
+    return df.rename(columns=names).to_csv(index=False)
+
+
+def to_nc(table):
+
+    ds = xr.Dataset({col: ('row', table[col].to_numpy()) for col in table.columns})
+    for col in table.columns:
+        if col in UNITS:
+            ds[col].attrs['units'] = UNITS[col]
+    return bytes(ds.to_netcdf(format='NETCDF3_CLASSIC', engine='scipy'))
+
+
+def timeit(func, *args, repeat=3):
+
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    table = make_table(n, np.random.default_rng(0))
+    contents = {'csvp': to_csvp(table), 'nc': to_nc(table), 'parquet': table.to_parquet()}
+
+    readers = {'csvp': lambda content: read_csv_text(content, index_col=0, parse_dates=True),
+               'nc': frame_from_nc,
+               'parquet': lambda content: frame_from_parquet(content, UNITS)}
+
+    print(f'{n} rows')
+    results = {}
+    for response, content in contents.items():
+        size = len(content.encode()) if isinstance(content, str) else len(content)
+        seconds, results[response] = timeit(readers[response], content)
+        print(f'{response:>8}: {size/1e6:8.1f} MB {seconds:8.3f} s')
+
+    # all formats read in the same. The scipy writer puts strings first
+    # in nc files so compare without the column order.
+    expected = results['csvp'].reset_index()
+    for response in ['nc', 'parquet']:
+        result = results[response].reset_index()[expected.columns]
+        for col in expected.columns:
+            if pd.api.types.is_float_dtype(expected[col]):
+                # csvp has float32 values as text
+                same = np.allclose(result[col], expected[col], rtol=1e-6)
+            else:
+                same = (result[col] == expected[col]).all()
+            assert same, f'{col} differs for {response}'
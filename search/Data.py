@@ -4,6 +4,31 @@ import search
 # from search.localReader import localReader
 
 import pandas as pd
+from joblib import Parallel, delayed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import threading
+import logging
+import os
+from search.variables import get_index
+
+
+# Capture warnings in log
+logging.captureWarnings(True)
+
+# formatting for logfile
+os.makedirs("../logs", exist_ok=True)  # succeeds even if directory exists.
+formatter = logging.Formatter('%(asctime)s %(message)s','%a %b %d %H:%M:%S %Z %Y')
+log_name = 'data'
+logfilename = os.path.join('..','logs', log_name + '.log')
+loglevel=logging.WARNING
+
+# set up logger file
+handler = logging.FileHandler(logfilename)
+handler.setFormatter(formatter)
+logger_data = logging.getLogger(log_name)
+logger_data.setLevel(loglevel)
+logger_data.addHandler(handler)
 
 # # data functions by data_type
 # DATASOURCES_GRID = [hfradar, seaice_extent, seaice_con]
@@ -23,6 +48,56 @@ OPTIONS = {'ErddapReader': {'known_server': ['ioos', 'coastwatch']},
 # MAYBE SHOULD BE ABLE TO INITIALIZE THE CLASS WITH ONLY METADATA OR DATASET NAMES?
 # to skip looking for the datasets
 
+
+def _all_variable_counts():
+    '''Counts of variables on each known server that has them.'''
+    
+    counts = {}
+    for known_server in OPTIONS['ErddapReader']['known_server']:
+        reader = search.ErddapReader.ErddapReader(known_server=known_server)
+        counts[reader.name] = reader.all_variables()
+    
+    # only platforms are searched by variable
+    reader = search.axdsReader.axdsReader(axds_type='platform2')
+    counts[reader.name] = reader.all_variables()
+    
+    return counts
+
+
+def variable_index():
+    '''Index of variable names on all known servers, built once per process.
+    
+    Use for autocomplete with `variable_index().complete('sal')`.
+    '''
+    
+    return get_index('all', _all_variable_counts)
+
+
+def search_variables(variables, fuzzy=False, limit=None):
+    '''Find variable names to use on any known server.
+    
+    Returns the total count and the count on each server of the names 
+    that contain any of `variables`, most common first. With `fuzzy`, 
+    close names are also returned, like for typos.
+    '''
+    
+    return variable_index().search(variables, fuzzy=fuzzy, limit=limit)
+
+
+def _get_attribute(source, attribute):
+    '''Trigger the property `attribute` of reader `source` and return it.'''
+    return getattr(source, attribute)
+
+
+def _record_failure(source, key, error):
+    '''Log `error` and keep it in the `failures` of reader `source`.'''
+    
+    logger_data.exception(error)
+    logger_data.warning(f'{key} failed for {source.name}')
+    if hasattr(source, 'failures'):
+        source.failures[key] = repr(error)
+
+
 class Data(object):
     
     def __init__(self, **kwargs):# kw=None, variables=None):
@@ -34,6 +109,11 @@ class Data(object):
 
         self.kwargs_all = kwargs_all
         
+        # total number of workers shared across all the readers
+        if not 'n_jobs' in self.kwargs_all:
+            self.kwargs_all['n_jobs'] = multiprocessing.cpu_count()
+        self.n_jobs = self.kwargs_all['n_jobs']
+        
         # default approach is region
         if not 'approach' in self.kwargs_all:
             self.kwargs_all['approach'] = 'region'
@@ -55,7 +135,9 @@ class Data(object):
         
         self.kwargs = kwargs 
         
-        self.sources
+        # readers are set up on first use, so setting up Data doesn't 
+        # use the network. Use `prefetch` to start in the background.
+        self._lock = threading.RLock()
         
     @property
     def sources(self):
@@ -158,22 +240,75 @@ class Data(object):
 
                     sources.append(reader)
 
+            # readers run at the same time so they split the 
+            # worker budget between them
+            n_jobs_reader = max(1, self.n_jobs // max(1, len(sources)))
+            for reader in sources:
+                # unless the user input their own value for this reader
+                if not ((reader.reader in self.kwargs.keys()) and ('n_jobs' in self.kwargs[reader.reader])):
+                    reader.n_jobs = n_jobs_reader
+
             self._sources = sources
         
         return self._sources
     
     
+    def prefetch(self, attribute='meta'):
+        '''Start finding `attribute` in a background thread.
+        
+        This returns right away with a `concurrent.futures.Future`. 
+        Accessing `attribute` afterward waits for the background work 
+        to finish instead of starting over.
+        
+        Examples
+        --------
+        >>> data = search.Data(kw=kw)
+        >>> data.prefetch('meta')
+        >>> # ... later
+        >>> data.meta
+        '''
+        
+        # setting up the readers is quick and doesn't use the network
+        self.sources
+        
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(_get_attribute, self, attribute)
+        executor.shutdown(wait=False)
+        
+        return future
+    
+    
+    def invalidate_cache(self):
+        '''Remove cached dataset_ids and metadata for all readers.'''
+        
+        for source in self.sources:
+            if hasattr(source, 'invalidate_cache'):
+                source.invalidate_cache()
+    
+    
+    def run_sources(self, attribute):
+        '''Access `attribute` of all readers at the same time.
+        
+        Each reader is run in its own thread so that the wall-clock 
+        time is set by the slowest reader instead of the sum over 
+        readers. Each reader runs its own datasets with its share of
+        `n_jobs` so the total stays within the budget.
+        '''
+        
+        n_threads = max(1, min(len(self.sources), self.n_jobs))
+        return Parallel(n_jobs=n_threads, backend='threading')(
+            delayed(_get_attribute)(source, attribute) for source in self.sources
+        )
+    
+    
     @property
     def dataset_ids(self):
         
-        if not hasattr(self, '_dataset_ids'):
+        with self._lock:
+            if not hasattr(self, '_dataset_ids'):
 
-            dataset_ids = []
-            for source in self.sources:
-
-                dataset_ids.append(source.dataset_ids)
-
-            self._dataset_ids = dataset_ids
+                # search all data sources at the same time
+                self._dataset_ids = self.run_sources('dataset_ids')
         
         return self._dataset_ids        
             
@@ -199,15 +334,11 @@ class Data(object):
         
         '''
         
-        if not hasattr(self, '_meta'):
-
-            # loop over data sources to read in metadata
-            meta = []
-            for source in self.sources:
-                
-                meta.append(source.meta)
+        with self._lock:
+            if not hasattr(self, '_meta'):
 
-            self._meta = meta
+                # read in metadata from all data sources at the same time
+                self._meta = self.run_sources('meta')
         
         return self._meta
     
@@ -216,16 +347,73 @@ class Data(object):
     def data(self):
         '''Return the data, given metadata.'''
         
-        if not hasattr(self, '_data'):
+        with self._lock:
+            if not hasattr(self, '_data'):
             
-            # loop over data sources to read in data
-            data = []
-            for source in self.sources:
-                
-                data.append(source.data)
-                
-            self._data = data
+                # read in data from all data sources at the same time
+                self._data = self.run_sources('data')
                 
         return self._data
     
     
+    
+    
+    def iter_data(self):
+        '''Yield data for each dataset as soon as it is read in.
+        
+        Unlike `data`, which returns only once every dataset from every
+        reader is in memory, this yields `(reader name, dataset_id, data)`
+        as each `data_by_dataset` call finishes, in the order they finish. 
+        The results are not stored so they can be dropped by the caller 
+        after processing.
+        
+        A dataset that fails to read in is yielded with None for data, and
+        a reader whose metadata can't be found is skipped, so one failure 
+        doesn't stop the others. Failures are logged and recorded in the
+        reader's `failures` by dataset_id, or under "meta".
+        
+        Metadata for all readers is found at the same time and each 
+        reader's datasets start being read in as soon as its metadata is 
+        available. At most `n_jobs` calls run at once.
+        
+        Examples
+        --------
+        >>> for name, dataset_id, dd in data.iter_data():
+        ...     process(dd)
+        '''
+        
+        executor = ThreadPoolExecutor(max_workers=max(1, self.n_jobs))
+        
+        try:
+            # start with metadata since each reader's data_by_dataset uses it
+            pending = {executor.submit(_get_attribute, source, 'meta'): (source, None)
+                       for source in self.sources}
+            
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                
+                for future in done:
+                    source, dataset_id = pending.pop(future)
+                    
+                    if dataset_id is None:
+                        try:
+                            future.result()
+                        except Exception as e:
+                            _record_failure(source, 'meta', e)
+                            continue
+                        # metadata is available so start reading in datasets
+                        for dataset_id in source.dataset_ids:
+                            future_data = executor.submit(source.data_by_dataset, dataset_id)
+                            pending[future_data] = (source, dataset_id)
+                    
+                    else:
+                        try:
+                            _, dd = future.result()
+                        except Exception as e:
+                            _record_failure(source, dataset_id, e)
+                            dd = None
+                        yield (source.name, dataset_id, dd)
+                        
+        finally:
+            # don't wait for the rest if the caller stopped early
+            executor.shutdown(wait=False, cancel_futures=True)
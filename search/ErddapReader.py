@@ -7,6 +7,16 @@ import logging
 from os
 import re
 import numpy as np
+import urllib.parse
+import time
+import io
+from search.transport import transport, read_csv_text, not_found
+from search.cache import QueryCache, StationMap, DataCache, hash_query
+from search.variables import VariableStore, get_index, reset_indexes
+from search.utils import (parse_info, parse_infos, parse_chunk_size, time_windows,
+                          spatial_constraints, clip_to_box, frame_from_nc, frame_from_parquet,
+                          griddap_query, count_rows, utc_timestamp, missing_intervals,
+                          griddap_time_url, empty_frame)
 
 
 # Capture warnings in log
@@ -31,16 +41,79 @@ logger_erd.addHandler(handler)
 # search.ErddapReader.reader
 reader = 'ErddapReader'
 
+# metadata columns that can be read for many datasets at once from a 
+# server's allDatasets table, and the allDatasets name for each
+ALL_DATASETS_COLUMNS = {'geospatial_lat_min': 'minLatitude', 
+                        'geospatial_lat_max': 'maxLatitude',
+                        'geospatial_lon_min': 'minLongitude', 
+                        'geospatial_lon_max': 'maxLongitude',
+                        'time_coverage_start': 'minTime', 
+                        'time_coverage_end': 'maxTime',
+                        'id': 'datasetID', 
+                        'infoUrl': 'infoUrl', 
+                        'institution': 'institution',
+                        'featureType': 'cdm_data_type', 
+                        'sourceUrl': 'sourceUrl'}
+
+
+def format_url(download_url, response):
+    '''Change the response format of tabledap csvp `download_url`.'''
+    
+    return download_url.replace('.csvp?', f'.{response}?', 1)
+
 
 class ErddapReader:
     
 
-    def __init__(self, known_server='ioos', protocol=None, server=None, parallel=True):
+    def __init__(self, known_server='ioos', protocol=None, server=None, parallel=True, n_jobs=None,
+                 cache_ttl=None, bulk_meta=False, columns=None, 
+                 time_chunks=None, chunk_retries=3, response='csvp', grid_stride=1,
+                 incremental=False, data_cache=False):
         
 #         # run checks for KW 
 #         self.kw = kw
 
         self.parallel = parallel
+        
+        # number of workers to use when running in parallel
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        self.n_jobs = n_jobs
+        
+        # dataset_ids and metadata for a query are reused for cache_ttl
+        self.query_cache = QueryCache(ttl=cache_ttl)
+        
+        # read the metadata columns in ALL_DATASETS_COLUMNS for all 
+        # datasets at once from allDatasets. Each dataset's info is still
+        # read for other columns, so this only saves requests when 
+        # `columns` are all in ALL_DATASETS_COLUMNS. Without info, griddap
+        # datasets are read with OPeNDAP instead of as .nc subsets.
+        self.bulk_meta = bulk_meta
+        
+        # split tabledap downloads into time chunks of a length ("30D"),
+        # number of rows (int), or number of bytes ("20MB")
+        self.time_chunks = time_chunks
+        self.chunk_retries = chunk_retries
+        
+        # format to download tabledap data in: "csvp", or "nc" or "parquet"
+        # which are already typed so are faster to read in. csvp is used 
+        # if the server can't return the format.
+        assert response in ['csvp', 'nc', 'parquet'], '`response` must be "csvp", "nc", or "parquet"'
+        self.response = response
+        
+        # take every `grid_stride` value along griddap dimensions, or a 
+        # dict of stride by dimension name
+        self.grid_stride = grid_stride
+        
+        # keep data locally and only read in time intervals that aren't 
+        # stored. With incremental, tabledap rows after the last time 
+        # stored are always read in.
+        self.data_cache = data_cache
+        self.incremental = incremental
+        
+        # why datasets could not be read in, by dataset_id, so they 
+        # aren't just missing from the data
+        self.failures = {}
     
         
         # either select a known server or input protocol and server string
@@ -64,16 +137,26 @@ class ErddapReader:
         self.e.server = server
                   
         # columns for metadata
-        self.columns = ['geospatial_lat_min', 'geospatial_lat_max', 
-               'geospatial_lon_min', 'geospatial_lon_max', 
-               'time_coverage_start', 'time_coverage_end',
-               'defaultDataQuery', 'subsetVariables',  # first works for timeseries sensors, 2nd for gliders
-               'keywords',  # for hf radar
-               'id', 'infoUrl', 'institution', 'featureType', 'source', 'sourceUrl']
+        # with bulk_meta, limiting these to ALL_DATASETS_COLUMNS avoids 
+        # reading each dataset's info
+        if columns is None:
+            columns = ['geospatial_lat_min', 'geospatial_lat_max', 
+                   'geospatial_lon_min', 'geospatial_lon_max', 
+                   'time_coverage_start', 'time_coverage_end',
+                   'defaultDataQuery', 'subsetVariables',  # first works for timeseries sensors, 2nd for gliders
+                   'keywords',  # for hf radar
+                   'id', 'infoUrl', 'institution', 'featureType', 'source', 'sourceUrl']
+        self.columns = columns
+        
+        if bulk_meta and (len(self.info_columns) > 0):
+            logger_erd.warning(f'bulk_meta still reads each dataset\'s info since allDatasets does not have '
+                               f'columns {self.info_columns}. Limit `columns` to ALL_DATASETS_COLUMNS to avoid it.')
         
         # name
         self.name = f'erddap_{known_server}'
         
+        self.cache = DataCache(self.name)
+        
         self.reader = 'ErddapReader'
         
 # #         self.data_type = data_type
@@ -82,47 +165,96 @@ class ErddapReader:
 
     
     
+    @property
+    def cache_key(self):
+        '''Key for this query in the query cache.'''
+        
+        # dataset_ids are part of the query if they were input
+        if (self.approach == 'stations') and (not self._stations):
+            dataset_ids = sorted(getattr(self, '_dataset_ids', []))
+        else:
+            dataset_ids = None
+        
+        # download urls in the metadata have the stride, and which columns 
+        # it has depends on columns and bulk_meta
+        return hash_query(reader=self.reader, server=self.e.server, protocol=self.e.protocol,
+                          approach=self.approach, kw=self.kw, variables=self.variables,
+                          stations=self._stations, dataset_ids=dataset_ids, 
+                          grid_stride=self.grid_stride, columns=self.columns, 
+                          bulk_meta=self.bulk_meta)
+    
+    
+    def invalidate_cache(self):
+        '''Remove cached dataset_ids and metadata for this query.
+        
+        The dataset_ids found for this query's stations are also removed 
+        from the station map so they are searched for again.
+        '''
+        
+        self.query_cache.invalidate(self.cache_key)
+        if self._stations:
+            StationMap(self.name).invalidate(self._stations)
+    
+    
+    def validate(self):
+        '''Make sure variables are on the parameter list.
+        
+        This is run before the first search instead of when the reader 
+        is set up since finding all variables can take a long time.
+        '''
+        
+        if not getattr(self, '_validated', False):
+            if getattr(self, 'variables', None) is not None:
+                self.check_variables(self.variables)
+            self._validated = True
+    
+    
     @property
     def dataset_ids(self):
         '''Find dataset_ids for server.'''
         
+        if (not hasattr(self, '_dataset_ids')) and self.query_cache.has(self.cache_key, 'dataset_ids'):
+            self._dataset_ids = self.query_cache.get(self.cache_key, 'dataset_ids')
+        
         if not hasattr(self, '_dataset_ids'):
             
+            self.validate()
+            
             # This should be a region search
             if self.approach == 'region':
         
                 # find all the dataset ids which we will use to get the data
                 # This limits the search to our keyword arguments in kw which should 
                 # have min/max lon/lat/time values
-                dataset_ids = []
                 if self.variables is not None:
-                    for variable in self.variables:
-
-                        # find and save all dataset_ids associated with variable
-                        search_url = self.e.get_search_url(response="csv", **self.kw, 
-                                                           variableName=variable, 
-                                                           items_per_page=10000)
-
-                        try:
-                            search = pd.read_csv(search_url)
-                            dataset_ids.extend(search["Dataset ID"])
-                        except Exception as e:
-                            logger_erd.exception(e)
-                            logger_erd.warning(f"variable {variable} was not found in the search")
-                            logger_erd.warning(f'search_url: {search_url}')
+                    # find all dataset_ids associated with each variable
+                    search_urls = [self.e.get_search_url(response="csv", **self.kw, 
+                                                         variableName=variable, 
+                                                         items_per_page=10000)
+                                   for variable in self.variables]
+                    messages = [f"variable {variable} was not found in the search"
+                                for variable in self.variables]
 
                 else:
                     
                     # find and save all dataset_ids associated with variable
-                    search_url = self.e.get_search_url(response="csv", **self.kw, 
-                                                       items_per_page=10000)
+                    search_urls = [self.e.get_search_url(response="csv", **self.kw, 
+                                                         items_per_page=10000)]
+                    messages = ["nothing found in the search"]
+
+                # run the searches at the same time
+                responses = transport.get_many(search_urls, cache=True)
 
+                dataset_ids = []
+                for search_url, message, response in zip(search_urls, messages, responses):
                     try:
-                        search = pd.read_csv(search_url)
+                        if isinstance(response, Exception):
+                            raise response
+                        search = read_csv_text(response)
                         dataset_ids.extend(search["Dataset ID"])
                     except Exception as e:
                         logger_erd.exception(e)
-                        logger_erd.warning(f"nothing found in the search")
+                        logger_erd.warning(message)
                         logger_erd.warning(f'search_url: {search_url}')
 
                     
@@ -133,15 +265,23 @@ class ErddapReader:
             elif self.approach == 'stations':
 #             elif self._stations is not None:
                 
-                # search by station name for each of stations
-                dataset_ids = []
-                for station in self._stations:
-                    # if station has more than one word, AND will be put between to search for multiple 
-                    # terms together
-                    url = self.e.get_search_url(response="csv", items_per_page=5, search_for=station)
-
+                # stations that were found before don't need to be searched for
+                station_map = StationMap(self.name)
+                found = station_map.get(self._stations)
+                stations = [station for station in self._stations if station not in found]
+                
+                # search by station name for the rest of stations at once
+                # if station has more than one word, AND will be put between to search for multiple 
+                # terms together
+                urls = [self.e.get_search_url(response="csv", items_per_page=5, search_for=station)
+                        for station in stations]
+                
+                resolved = {}
+                for station, url, response in zip(stations, urls, transport.get_many(urls, cache=True)):
                     try:
-                        df = pd.read_csv(url)
+                        if isinstance(response, Exception):
+                            raise response
+                        df = read_csv_text(response)
                     except Exception as e:
                         logger_erd.exception(e)
                         logger_erd.warning(f'search url {url} did not work for station {station}.')
@@ -165,44 +305,34 @@ class ErddapReader:
 #                     except:
 #                         dataset_id = None
                 
-                    dataset_ids.append(dataset_id)
+                    resolved[station] = dataset_id
+                
+                station_map.update(resolved)
+                dataset_ids = list(found.values()) + list(resolved.values())
                     
                 self._dataset_ids = list(set(dataset_ids))
                 
             else:
                 logger_erd.warning('Neither stations nor region approach were used in function dataset_ids.')
                 
+            if hasattr(self, '_dataset_ids'):
+                self.query_cache.set(self.cache_key, 'dataset_ids', self._dataset_ids)
             
         return self._dataset_ids
         
     
-    def meta_by_dataset(self, dataset_id):
-
-        info_url = self.e.get_info_url(response="csv", dataset_id=dataset_id)
-        info = pd.read_csv(info_url)
-
-        items = []
+    def meta_by_dataset(self, dataset_id, info=None):
+        '''Metadata for `dataset_id`.
+        
+        `info` is the dataset's info csv as a DataFrame if it has 
+        already been read in, otherwise it is requested here.
+        '''
 
-        for col in self.columns:
+        if info is None:
+            info_url = self.e.get_info_url(response="csv", dataset_id=dataset_id)
+            info = read_csv_text(transport.get(info_url, cache=True))
 
-            try:
-                item = info[info['Attribute Name'] == col]['Value'].values[0]
-                dtype = info[info['Attribute Name'] == col]['Data Type'].values[0]
-            except:
-                if col == 'featureType':
-                    # this column is not present in HF Radar metadata but want it to
-                    # map to data_type, so input 'grid' in that case.
-                    item = 'grid'
-                else:
-                    item = 'NA'
-
-            if dtype == 'String':
-                pass
-            elif dtype == 'double':
-                item = float(item)
-            elif dtype == 'int':
-                item = int(item)
-            items.append(item)
+        items = parse_info(info, self.columns)
             
 #         if self.standard_names is not None:
 #             # In case the variable is named differently from the standard names, 
@@ -215,61 +345,211 @@ class ErddapReader:
 #         else:
 #             varnames = None
 
-        ## include download link ##
-        self.e.dataset_id = dataset_id
-        if self.e.protocol == 'tabledap':
+        # add erddap server name
+        return {dataset_id: [self.e.server, self.download_url(dataset_id, info=info)] + items + [self.variables]}
+    
+    
+    def lon_range(self, meta, dataset_id):
+        '''(min, max) longitude of `dataset_id` from `meta` or None.'''
+        
+        try:
+            lon_range = (float(meta.loc[dataset_id, 'geospatial_lon_min']), 
+                         float(meta.loc[dataset_id, 'geospatial_lon_max']))
+        except (KeyError, ValueError, TypeError):
+            return None
+        
+        if np.isnan(lon_range).any():
+            return None
+        
+        return lon_range
+    
+    
+    def download_url(self, dataset_id, min_time=None, max_time=None, last=True, lon_range=None,
+                     info=None, first=True):
+        '''Url to read in data for `dataset_id` within `kw`.
+        
+        For tabledap, `min_time` and `max_time` can narrow the time range
+        from `kw`. `max_time` is only included if `last` is True and 
+        `min_time` if `first` is True. If the dataset's `lon_range` is 
+        known, it has latitude and longitude so the lon/lat box in `kw` is 
+        also sent to the server.
+        
+        For griddap, the dataset's `info` csv gives its dimensions so the 
+        url can be for a `.nc` subset within `kw`. Otherwise it is the 
+        OPeNDAP url.
+        '''
+
+        # use a separate instance since this runs in threads
+        e = ERDDAP(server=self.e.server, protocol=self.e.protocol)
+        e.dataset_id = dataset_id
+        if e.protocol == 'tabledap':
             if self.variables is not None:
-                self.e.variables = ["time","longitude", "latitude", "station"] + self.variables
+                e.variables = ["time","longitude", "latitude", "station"] + self.variables
             # set the same time restraints as before
-            self.e.constraints = {'time<=': self.kw['max_time'], 'time>=': self.kw['min_time'],}
-            download_url = self.e.get_download_url(response='csvp')
+            min_time = self.kw['min_time'] if min_time is None else min_time
+            max_time = self.kw['max_time'] if max_time is None else max_time
+            e.constraints = {'time<=' if last else 'time<': max_time, 'time>=' if first else 'time>': min_time,}
+            if lon_range is not None:
+                e.constraints.update(spatial_constraints(self.kw, lon_range))
+            download_url = e.get_download_url(response='csvp')
 
-        elif self.e.protocol == 'griddap':
+        elif e.protocol == 'griddap':
             # the search terms that can be input for tabledap do not work for griddap
-            # in erddapy currently. Instead, put together an opendap link and then 
-            # narrow the dataset with xarray.
-            # get opendap link
-            download_url = self.e.get_download_url(response='opendap')
+            # in erddapy currently. Instead, put together the hyperslab from the 
+            # dimensions in info.
+            query = griddap_query(info, self.kw, self.variables, self.grid_stride) if info is not None else None
+            if query is not None:
+                download_url = f'{e.server}/griddap/{dataset_id}.nc?{query}'
+            else:
+                # get opendap link and narrow the dataset with xarray.
+                download_url = e.get_download_url(response='opendap')
         
-        # add erddap server name
-        return {dataset_id: [self.e.server, download_url] + items + [self.variables]}
+        return download_url
+    
+    
+    @property
+    def info_columns(self):
+        '''Metadata `columns` that allDatasets doesn't have.'''
+        
+        return [col for col in self.columns if col not in ALL_DATASETS_COLUMNS]
+    
+    
+    def meta_all_datasets(self):
+        '''Metadata for all dataset_ids from the server's allDatasets table.
+        
+        This takes one request per 100 datasets instead of one per dataset
+        but only has the columns in `ALL_DATASETS_COLUMNS`.
+        '''
+        
+        names = sorted(set(ALL_DATASETS_COLUMNS.values()))
+        
+        # limit the number of dataset_ids in each url to keep it short
+        urls = []
+        for i in range(0, len(self.dataset_ids), 100):
+            regex = '|'.join([re.escape(dataset_id) for dataset_id in self.dataset_ids[i:i+100]])
+            constraint = urllib.parse.quote(f'datasetID=~"({regex})"', safe='=~')
+            urls.append(f'{self.e.server}/tabledap/allDatasets.csvp?{",".join(names)}&{constraint}')
+        
+        tables = []
+        for response in transport.get_many(urls, cache=True):
+            if isinstance(response, Exception):
+                raise response
+            table = read_csv_text(response)
+            # csvp column names include units
+            table.columns = [col.split(' (')[0] for col in table.columns]
+            tables.append(table)
+        table = pd.concat(tables).drop_duplicates('datasetID').set_index('datasetID', drop=False)
+        table = table.reindex(self.dataset_ids)
+        
+        meta = pd.DataFrame(index=self.dataset_ids)
+        meta['database'] = self.e.server
+        lons = table.rename(columns={'minLongitude': 'geospatial_lon_min', 
+                                     'maxLongitude': 'geospatial_lon_max'})
+        meta['download_url'] = [self.download_url(dataset_id, lon_range=self.lon_range(lons, dataset_id)) 
+                                for dataset_id in self.dataset_ids]
+        for col in self.columns:
+            if col in ALL_DATASETS_COLUMNS:
+                meta[col] = table[ALL_DATASETS_COLUMNS[col]].values
+        
+        # match featureType from info, which is "grid" for datasets 
+        # without one, like grids and cdm_data_type "Other"
+        if 'featureType' in meta.columns:
+            meta['featureType'] = meta['featureType'].replace({'Grid': 'grid', 'Other': 'grid'})
+        
+        return meta
+    
+    
+    def meta_info(self, columns=None):
+        '''Metadata for all dataset_ids from each dataset's info csv.
+        
+        Only `columns` are parsed, or all of `self.columns` if None.
+        '''
+        
+        columns = self.columns if columns is None else columns
+        
+        info_urls = [self.e.get_info_url(response="csv", dataset_id=dataset_id)
+                     for dataset_id in self.dataset_ids]
+        
+        if self.parallel:
+            # get info for all datasets at once
+            responses = transport.get_many(info_urls, cache=True)
+        else:
+            responses = []
+            for info_url in info_urls:
+                try:
+                    responses.append(transport.get(info_url, cache=True))
+                except Exception as e:
+                    responses.append(e)
+        
+        infos = {}
+        for dataset_id, response in zip(self.dataset_ids, responses):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                infos[dataset_id] = read_csv_text(response)
+            except Exception as e:
+                logger_erd.exception(e)
+                logger_erd.warning(f'no metadata to be read in for {dataset_id}')
+
+        # parse all info at once
+        # longitudes are also needed for the download urls
+        lon_columns = ['geospatial_lon_min', 'geospatial_lon_max']
+        meta = parse_infos(infos, list(dict.fromkeys(columns + lon_columns)))
+        meta.insert(0, 'database', self.e.server)
+        meta.insert(1, 'download_url', [self.download_url(dataset_id, lon_range=self.lon_range(meta, dataset_id),
+                                                          info=infos[dataset_id]) 
+                                        for dataset_id in meta.index])
+        meta['variable names'] = pd.Series([self.variables]*len(meta), index=meta.index, dtype=object)
+        
+        return meta[['database', 'download_url'] + list(columns) + ['variable names']]
     
       
     @property
     def meta(self):
         
+        if (not hasattr(self, '_meta')) and self.query_cache.has(self.cache_key, 'meta'):
+            self._meta = self.query_cache.get(self.cache_key, 'meta')
+        
         if not hasattr(self, '_meta'):
             
-            if self.parallel:
+            meta = None
+            if self.bulk_meta:
+                try:
+                    meta = self.meta_all_datasets()
+                except Exception as e:
+                    logger_erd.exception(e)
+                    logger_erd.warning('allDatasets could not be read in so using info for each dataset.')
+            
+            if meta is None:
+                meta = self.meta_info()
             
-                # get metadata for datasets
-                # run in parallel to save time
-                num_cores = multiprocessing.cpu_count()
-                downloads = Parallel(n_jobs=num_cores)(
-                    delayed(self.meta_by_dataset)(dataset_id) for dataset_id in self.dataset_ids
-                )
-                
             else:
-
-                downloads = []
-                for dataset_id in self.dataset_ids:
-                    downloads.append(self.meta_by_dataset(dataset_id))
-
-            # make dict from individual dicts
-            from collections import ChainMap
-            meta = dict(ChainMap(*downloads)) 
-
-            # Make dataframe of metadata
-            # variable names are the column names for the dataframe
-            self._meta = pd.DataFrame.from_dict(meta, orient='index', 
-                                                columns=['database','download_url'] \
-                                                + self.columns + ['variable names'])
+                if len(self.info_columns) > 0:
+                    # only the columns allDatasets doesn't have are from info
+                    meta_info = self.meta_info(self.info_columns)
+                    for col in self.info_columns:
+                        meta[col] = meta_info[col].reindex(meta.index).fillna('NA')
+                    # urls built with info have griddap subsets
+                    urls = meta_info['download_url'].reindex(meta.index)
+                    meta['download_url'] = urls.where(urls.notnull(), meta['download_url'])
+                meta['variable names'] = pd.Series([self.variables]*len(meta), 
+                                                   index=meta.index, dtype=object)
+                # same column order as from info
+                meta = meta[['database','download_url'] + self.columns + ['variable names']]
+            
+            self._meta = meta
+            
+            self.query_cache.set(self.cache_key, 'meta', self._meta)
            
         return self._meta       
     
     
     def data_by_dataset(self, dataset_id):
 
+        if dataset_id not in self.meta.index:
+            logger_erd.warning('no metadata so no data to be read in for %s' % dataset_id)
+            return (dataset_id, None)
+
         download_url = self.meta.loc[dataset_id, 'download_url']
         # data variables in ds that are not the variables we searched for
 #         varnames = self.meta.loc[dataset_id, 'variable names']
@@ -280,10 +560,17 @@ class ErddapReader:
 
                 # fetch metadata if not already present
                 # found download_url from metadata and use
-                dd = pd.read_csv(download_url, index_col=0, parse_dates=True)
+                if self.data_cache or self.incremental:
+                    dd = self.read_cached(dataset_id)
+                else:
+                    dd = self.read_tabledap(dataset_id)
                 
                 # Drop cols and rows that are only NaNs.
                 dd = dd.dropna(axis='index', how='all').dropna(axis='columns', how='all')
+                
+                # clip anything the server didn't, like trajectories 
+                # without spatial constraints
+                dd = clip_to_box(dd, self.kw)
 
                 if self.variables is not None:
                     # check to see if there is any actual data
@@ -298,19 +585,38 @@ class ErddapReader:
                     
             except Exception as e:
                 logger_erd.exception(e)
+                self.failures[dataset_id] = repr(e)
                 logger_erd.warning('no data to be read in for %s' % dataset_id)
                 dd = None
         
         elif self.e.protocol == 'griddap':
 
             try:
-                dd = xr.open_dataset(download_url, chunks='auto').sel(time=slice(self.kw['min_time'],self.kw['max_time']))
+                dd = None
+                if ('.nc?' in download_url) and self.data_cache:
+                    dd = self.read_cached_grid(dataset_id)
+                    if dd is None:
+                        # nothing stored within kw, so like a subset that 
+                        # couldn't be read in
+                        download_url = f'{self.e.server}/griddap/{dataset_id}'
+                
+                elif '.nc?' in download_url:
+                    # only the subset is transferred
+                    try:
+                        content = transport.get(download_url, response='bytes')
+                        dd = xr.open_dataset(io.BytesIO(content)).load()
+                    except Exception as e:
+                        logger_erd.warning(f'could not read subset of {dataset_id} so using opendap: {e}')
+                        download_url = f'{self.e.server}/griddap/{dataset_id}'
+                
+                if dd is None:
+                    dd = xr.open_dataset(download_url, chunks='auto').sel(time=slice(self.kw['min_time'],self.kw['max_time']))
 
-                if ('min_lat' in self.kw) and ('max_lat' in self.kw):
-                    dd = dd.sel(latitude=slice(self.kw['min_lat'],self.kw['max_lat']))
+                    if ('min_lat' in self.kw) and ('max_lat' in self.kw):
+                        dd = dd.sel(latitude=slice(self.kw['min_lat'],self.kw['max_lat']))
 
-                if ('min_lon' in self.kw) and ('max_lon' in self.kw):
-                    dd = dd.sel(longitude=slice(self.kw['min_lon'],self.kw['max_lon']))
+                    if ('min_lon' in self.kw) and ('max_lon' in self.kw):
+                        dd = dd.sel(longitude=slice(self.kw['min_lon'],self.kw['max_lon']))
 
                 # use variable names to drop other variables (should. Ido this?)
                 if self.variables is not None:
@@ -319,20 +625,229 @@ class ErddapReader:
                 
             except Exception as e:
                 logger_erd.exception(e)
+                self.failures[dataset_id] = repr(e)
                 logger_erd.warning('no data to be read in for %s' % dataset_id)
                 dd = None
                 
         return (dataset_id, dd)
 
 
+    def units_by_dataset(self, dataset_id):
+        '''Units of each variable in `dataset_id` from its info csv.'''
+        
+        url = f'{self.e.server}/info/{dataset_id}/index.csv'
+        info = read_csv_text(transport.get(url, cache=True))
+        info = info[info['Attribute Name'] == 'units']
+        
+        return dict(zip(info['Variable Name'], info['Value']))
+    
+    
+    def decode(self, dataset_id, content, response='csvp'):
+        '''DataFrame from the `content` of a tabledap response.'''
+        
+        if response == 'nc':
+            return frame_from_nc(content)
+        elif response == 'parquet':
+            return frame_from_parquet(content, self.units_by_dataset(dataset_id))
+        else:
+            return read_csv_text(content, index_col=0, parse_dates=True)
+    
+    
+    def read_tabledap(self, dataset_id, download_url=None):
+        '''Read in tabledap data for `dataset_id` as `self.response`.
+        
+        `download_url` is the url from the metadata unless input, and is 
+        read in with one request instead of in time chunks.
+        
+        If that doesn't work, the data is read in as csvp instead. No 
+        data (404) is the same in every format so isn't tried again.
+        '''
+        
+        for response in dict.fromkeys([self.response, 'csvp']):
+            try:
+                if (self.time_chunks is not None) and (download_url is None):
+                    return self.data_by_time_chunks(dataset_id, response)
+                
+                url = download_url if download_url is not None else self.meta.loc[dataset_id, 'download_url']
+                url = format_url(url, response)
+                content = transport.get(url, response='text' if response == 'csvp' else 'bytes')
+                return self.decode(dataset_id, content, response)
+            
+            except Exception as e:
+                if (response == 'csvp') or not_found(e):
+                    raise
+                logger_erd.warning(f'could not read {response} for {dataset_id} so reading csvp: {e}')
+    
+    
+    def data_key(self, dataset_id):
+        '''Key for the data stored for `dataset_id` by this query.
+        
+        The time range isn't part of the key since that is what is added 
+        to.
+        '''
+        
+        box = {key: value for key, value in self.kw.items() if key not in ['min_time', 'max_time']}
+        return hash_query(server=self.e.server, dataset_id=dataset_id, variables=self.variables, 
+                          box=box, grid_stride=self.grid_stride)
+    
+    
+    def read_cached(self, dataset_id):
+        '''Read in tabledap data for `dataset_id` through the data cache.
+        
+        Only the time intervals within `kw` that aren't stored are 
+        requested, then everything within `kw` is read from the store. 
+        With `incremental`, the interval at the end starts after the last 
+        time stored, so rows added since then are read in too.
+        '''
+        
+        min_time, max_time = utc_timestamp(self.kw['min_time']), utc_timestamp(self.kw['max_time'])
+        key = self.data_key(dataset_id)
+        covered = self.cache.coverage(key)
+        missing = missing_intervals(covered, min_time, max_time)
+        
+        last = self.cache.last_time(key)
+        if self.incremental and (last is not None) and (min_time <= last < max_time):
+            missing = [(start, min(end, last)) for start, end in missing if start < last] + [(last, max_time)]
+        
+        lon_range = self.lon_range(self.meta, dataset_id)
+        now = pd.Timestamp.now(tz='UTC')
+        for start, end in missing:
+            after_last = self.incremental and (start == last)
+            url = self.download_url(dataset_id, min_time=start, max_time=end, 
+                                    first=not after_last, lon_range=lon_range)
+            try:
+                self.cache.write(key, self.read_tabledap(dataset_id, download_url=url))
+            except Exception as e:
+                # no data in the interval
+                if not not_found(e):
+                    raise
+            # data can't be stored for times that haven't happened yet
+            self.cache.add_coverage(key, [(start, min(end, now))])
+        
+        data = self.cache.read(key, min_time, max_time)
+        # no data within kw isn't a failure, like a 404 from each interval
+        return empty_frame('time (UTC)') if data is None else data
+    
+    
+    def read_cached_grid(self, dataset_id):
+        '''Read in griddap data for `dataset_id` through the data cache.
+        
+        Only the time intervals within `kw` that aren't stored are 
+        requested as .nc subsets.
+        '''
+        
+        min_time, max_time = utc_timestamp(self.kw['min_time']), utc_timestamp(self.kw['max_time'])
+        key = self.data_key(dataset_id)
+        download_url = self.meta.loc[dataset_id, 'download_url']
+        
+        now = pd.Timestamp.now(tz='UTC')
+        for start, end in missing_intervals(self.cache.coverage(key), min_time, max_time):
+            url = griddap_time_url(download_url, start, end)
+            if url is not None:
+                content = transport.get(url, response='bytes')
+                self.cache.write(key, xr.open_dataset(io.BytesIO(content)).load())
+            self.cache.add_coverage(key, [(start, min(end, now))])
+        
+        return self.cache.read(key, min_time, max_time)
+    
+    
+    def read_time_chunks(self, dataset_id, windows, response='csvp'):
+        '''Read in the response for each time window of `dataset_id` at once.
+        
+        Windows that fail are requested again on their own, up to 
+        `chunk_retries` times. Windows without data are None.
+        '''
+        
+        max_time = pd.Timestamp(self.kw['max_time'])
+        lon_range = self.lon_range(self.meta, dataset_id)
+        urls = [format_url(self.download_url(dataset_id, start, end, last=(end >= max_time), lon_range=lon_range), response)
+                for start, end in windows]
+        body = 'text' if response == 'csvp' else 'bytes'
+        
+        contents = [None]*len(urls)
+        todo = list(range(len(urls)))
+        for attempt in range(self.chunk_retries + 1):
+            if attempt > 0:
+                time.sleep(2**(attempt - 1))
+            
+            failed = []
+            for i, content in zip(todo, transport.get_many([urls[i] for i in todo], response=body)):
+                # ERDDAP returns 404 if there is no data in the window
+                if not_found(content):
+                    continue
+                elif isinstance(content, Exception):
+                    logger_erd.warning(f'time chunk {windows[i]} for {dataset_id} failed: {content}')
+                    failed.append(i)
+                else:
+                    contents[i] = content
+            
+            todo = failed
+            if len(todo) == 0:
+                break
+        
+        if len(todo) > 0:
+            raise IOError(f'time chunks {[windows[i] for i in todo]} could not be read in for {dataset_id}')
+        
+        return contents
+    
+    
+    def data_by_time_chunks(self, dataset_id, response='csvp'):
+        '''Read in tabledap data for `dataset_id` in time chunks.
+        
+        The time range in `kw` is split into windows by `time_chunks` and
+        the windows are requested at the same time, then put back together
+        in time order. For a number of rows or bytes, the first day is read
+        in first to find how long the windows should be.
+        '''
+        
+        min_time, max_time = pd.Timestamp(self.kw['min_time']), pd.Timestamp(self.kw['max_time'])
+        kind, size = parse_chunk_size(self.time_chunks)
+        
+        contents = []
+        if kind == 'time':
+            windows = time_windows(min_time, max_time, size)
+        
+        else:
+            # find the amount of data per day from the first day
+            probe_end = min(min_time + pd.Timedelta('1D'), max_time)
+            contents = self.read_time_chunks(dataset_id, [(min_time, probe_end)], response)
+            
+            if contents[0] is None:
+                amount = 0
+            elif kind == 'rows':
+                amount = len(self.decode(dataset_id, contents[0], response))
+            else:
+                amount = len(contents[0]) if isinstance(contents[0], bytes) else len(contents[0].encode())
+            
+            days = (probe_end - min_time) / pd.Timedelta('1D')
+            if (amount == 0) or (days == 0):
+                freq = max_time - probe_end
+            else:
+                freq = pd.Timedelta(days=size/(amount/days))
+            # don't make very many tiny requests
+            freq = max(freq, pd.Timedelta('1h'))
+            
+            windows = time_windows(probe_end, max_time, freq) if probe_end < max_time else []
+        
+        contents += self.read_time_chunks(dataset_id, windows, response)
+        
+        frames = [self.decode(dataset_id, content, response) for content in contents if content is not None]
+        assert len(frames) > 0, f'no data in any time chunk for {dataset_id}'
+        
+        return pd.concat(frames).sort_index(kind='stable')
+    
+    
     @property
     def data(self):
         
         if not hasattr(self, '_data'):
             
+            # find metadata once before the threads need it
+            self.meta
+            
             if self.parallel:
-                num_cores = multiprocessing.cpu_count()
-                downloads = Parallel(n_jobs=num_cores)(
+                # requests are async so threads are enough here
+                downloads = Parallel(n_jobs=self.n_jobs, prefer='threads')(
                     delayed(self.data_by_dataset)(dataset_id) for dataset_id in self.dataset_ids
                 )
             else:
@@ -352,40 +867,93 @@ class ErddapReader:
     
     def count(self,url):
         try:
-            return len(pd.read_csv(url))    
+            return count_rows(transport.get(url))
         except:
             return np.nan
 
     
-    def all_variables(self):
-        '''Return a list of all possible variables.'''
+    def all_variables(self, max_age=None):
+        '''Return a list of all possible variables.
         
+        The number of datasets with each variable is stored locally. Once 
+        the store is older than `max_age` (seconds or a string like "7D"), 
+        the list of variables is requested again. New variables are 
+        counted, and variables with counts older than `max_age` are 
+        requested with the ETag and Last-Modified of their last listing so
+        only listings that changed are counted again. With `max_age=None`, 
+        a store that exists is always used. Only one process refreshes the
+        store at a time.
+        '''
+        
+        store = VariableStore(f'erddap_{self.known_server}')
+        variables = store.load()
+        
+        # counts from before there was a store
         file_name_counts = f'erddap_variable_list_{self.known_server}.csv'
+        if (variables is None) and os.path.exists(file_name_counts):
+            variables = pd.read_csv(file_name_counts, index_col='variable')
+            variables['refreshed'] = os.path.getmtime(file_name_counts)
+            store.save(variables)
         
-        if os.path.exists(file_name_counts):
-            return pd.read_csv(file_name_counts, index_col='variable')
-        else:
-            # This took 10 min running in parallel for ioos
-            # 2 min for coastwatch
+        if isinstance(max_age, str):
+            max_age = pd.Timedelta(max_age).total_seconds()
+        
+        def fresh(variables):
+            return (variables is not None) and ((max_age is None) or (time.time() - store.refreshed < max_age))
+        
+        if fresh(variables):
+            return variables[['count']]
+        
+        with store.lock():
+            # another process may have refreshed it while we waited
+            variables = store.load()
+            if fresh(variables):
+                return variables[['count']]
+            
+            # this used to take 10 min for ioos, 2 min for coastwatch, since 
+            # every variable was counted with a full read of its csv
+            now = time.time()
             url = f'{self.e.server}/categorize/variableName/index.csv?page=1&itemsPerPage=100000'
-            df = pd.read_csv(url)
-#             counts = []
-#             for url in df.URL:
-#                 counts.append(self.count(url))
-            num_cores = multiprocessing.cpu_count()
-            counts = Parallel(n_jobs=num_cores)(
-                delayed(self.count)(url) for url in df.URL
-            )
-            dfnew = pd.DataFrame()
-            dfnew['variable'] = df['Category']
-            dfnew['count'] = counts
-            dfnew = dfnew.set_index('variable')
+            categories = read_csv_text(transport.get(url, cache=True)).set_index('Category')
+            
+            if variables is None:
+                variables = pd.DataFrame(columns=['count', 'refreshed'], dtype=float)
+            variables = variables.reindex(categories.index).rename_axis('variable')
+            for col in ['etag', 'last_modified']:
+                if col not in variables:
+                    variables[col] = None
+                variables[col] = variables[col].astype(object)
+            
+            # new variables and old counts at the same time, but old counts 
+            # are only counted again if their listing changed
+            stale = store.stale(variables, 0 if max_age is None else max_age, now)
+            urls = categories.loc[stale.values, 'URL']
+            validators = [validator if pd.notnull(variables.loc[variable, 'count']) else {}
+                          for variable, validator in zip(urls.index, store.validators(variables.loc[urls.index]))]
+            responses = transport.get_many_if_changed(urls, validators, response='text')
+            updates = {}
+            for variable, response in zip(urls.index, responses):
+                if isinstance(response, Exception):
+                    # keep the old count if there is one
+                    logger_erd.warning(f'could not count datasets with variable {variable}: {response}')
+                    continue
+                body, validator = response
+                count = count_rows(body) if body is not None else variables.loc[variable, 'count']
+                updates[variable] = [count, now, validator.get('etag'), validator.get('last_modified')]
+            if len(updates) > 0:
+                updates = pd.DataFrame.from_dict(updates, orient='index', 
+                                                 columns=['count', 'refreshed', 'etag', 'last_modified'])
+                variables.loc[updates.index, updates.columns] = updates
+            
             # remove nans
-            if (dfnew.isnull().sum() > 0).values:
-                dfnew = dfnew[~dfnew.isnull().values].astype(int)
-            dfnew.to_csv(file_name_counts)
+            variables = variables.dropna(subset=['count'])
+            variables['count'] = variables['count'].astype(int)
+            store.save(variables)
+        
+        # indexes of names were built from the old counts
+        reset_indexes()
         
-        return dfnew
+        return variables[['count']]
 
 
     def search_variables(self, variables):
@@ -395,25 +963,11 @@ class ErddapReader:
         Call with `search_variables('salinity')` to return relevant names.
         '''
         
-        if not isinstance(variables, list):
-            variables = [variables]
-        
-        # set up search for input variables
-        search = f"(?i)"
-        for variable in variables:
-            search += f".*{variable}|"
-        search = search.strip('|')
-
-        r = re.compile(search)
+        # the index of names is built once per process
+        index = get_index(self.name, lambda: {self.name: self.all_variables()})
         
-        # just get the variable names
-        df = self.all_variables()
-        parameters = df.index
-
-        matches = list(filter(r.match, parameters))
-
         # return parameters that match input variable strings
-        return df.loc[matches].sort_values('count', ascending=False)
+        return index.search(variables)[['count']]
     
     
     def check_variables(self, variables, verbose=False):
@@ -422,22 +976,24 @@ class ErddapReader:
             variables = [variables]
             
 #         parameters = list(self.all_variables().keys())
-        parameters = list(self.all_variables().index)
+        parameters = set(self.all_variables().index)
         
         # for a variable to exactly match a parameter 
         # this should equal 1
         count = []
         for variable in variables:
-            count += [parameters.count(variable)]
+            count += [int(variable in parameters)]
         
         condition = np.allclose(count,1)
         
-        assertion = f'The input variables are not exact matches to ok variables for known_server {self.known_server}. \
-                     \nCheck all parameter group values with `ErddapReader().all_variables()` \
-                     \nor search parameter group values with `ErddapReader().search_variables({variables})`.\
-                     \n\n Try some of the following variables:\n{str(self.search_variables(variables))}'# \
-#                      \nor run `ErddapReader().check_variables("{variables}")'
-        assert condition, assertion
+        # only search for suggestions if there is a problem
+        if not condition:
+            assertion = f'The input variables are not exact matches to ok variables for known_server {self.known_server}. \
+                         \nCheck all parameter group values with `ErddapReader().all_variables()` \
+                         \nor search parameter group values with `ErddapReader().search_variables({variables})`.\
+                         \n\n Try some of the following variables:\n{str(self.search_variables(variables))}'# \
+#                          \nor run `ErddapReader().check_variables("{variables}")'
+            assert condition, assertion
         
         if condition and verbose:
             print('all variables are matches!')
@@ -451,7 +1007,17 @@ class region(ErddapReader):
         er_kwargs = {'known_server': kwargs.get('known_server', 'ioos'),
                      'protocol': kwargs.get('protocol', None),
                      'server': kwargs.get('server', None),
-                     'parallel': kwargs.get('parallel', True)}
+                     'parallel': kwargs.get('parallel', True),
+                     'n_jobs': kwargs.get('n_jobs', None),
+                     'cache_ttl': kwargs.get('cache_ttl', None),
+                     'bulk_meta': kwargs.get('bulk_meta', False),
+                     'columns': kwargs.get('columns', None),
+                     'time_chunks': kwargs.get('time_chunks', None),
+                     'chunk_retries': kwargs.get('chunk_retries', 3),
+                     'response': kwargs.get('response', 'csvp'),
+                     'grid_stride': kwargs.get('grid_stride', 1),
+                     'incremental': kwargs.get('incremental', False),
+                     'data_cache': kwargs.get('data_cache', False)}
         ErddapReader.__init__(self, **er_kwargs)
 
         kw = kwargs['kw']
@@ -468,9 +1034,8 @@ class region(ErddapReader):
         if (variables is not None) and (not isinstance(variables, list)):
             variables = [variables]
 
-        # make sure variables are on parameter list
-        if variables is not None:
-            self.check_variables(variables)
+        # variables are checked against the parameter list on first
+        # use in `validate` since that can require a long download
         self.variables = variables
 
 
@@ -499,7 +1064,17 @@ class stations(ErddapReader):
         er_kwargs = {'known_server': kwargs.get('known_server', 'ioos'),
                      'protocol': kwargs.get('protocol', None),
                      'server': kwargs.get('server', None),
-                     'parallel': kwargs.get('parallel', True)}
+                     'parallel': kwargs.get('parallel', True),
+                     'n_jobs': kwargs.get('n_jobs', None),
+                     'cache_ttl': kwargs.get('cache_ttl', None),
+                     'bulk_meta': kwargs.get('bulk_meta', False),
+                     'columns': kwargs.get('columns', None),
+                     'time_chunks': kwargs.get('time_chunks', None),
+                     'chunk_retries': kwargs.get('chunk_retries', 3),
+                     'response': kwargs.get('response', 'csvp'),
+                     'grid_stride': kwargs.get('grid_stride', 1),
+                     'incremental': kwargs.get('incremental', False),
+                     'data_cache': kwargs.get('data_cache', False)}
         ErddapReader.__init__(self, **er_kwargs)
         
         kw = kwargs.get('kw', None)
@@ -521,7 +1096,6 @@ class stations(ErddapReader):
             if not isinstance(stations, list):
                 stations = [stations]
             self._stations = stations
-            self.dataset_ids
         else:
             self._stations = stations
 
@@ -8,7 +8,7 @@ import search.ErddapReader
 import search.axdsReader
 import search.localReader
 
-from .Data import (Data)
+from .Data import (Data, search_variables, variable_index)
 # import Data
 # from .ErddapReader import (ErddapReader, region)
 # from .axdsReader import (axdsReader)
@@ -4,12 +4,20 @@ import pandas as pd
 import xarray as xr
 import logging
 import os
-import requests
+import time
 import intake
-import shapely.wkt
+import shapely
 import re
 import numpy as np
-import hashlib
+import io
+import gzip
+import fsspec
+from search.transport import transport
+from search.cache import QueryCache, StationMap, OpendapUrls, DataCache, hash_query
+from search.utils import (utc_timestamp, utc_end, missing_intervals, read_csv_window, time_key, 
+                          time_indexer, empty_frame)
+from search.variables import VariableStore, get_index, reset_indexes
+from search.catalogs import make_catalog, export_catalog, CatalogStore
 
 os.makedir("../catalogs", exist_ok=True)  # succeeds even if directory exists.
 
@@ -40,11 +48,34 @@ reader = 'axdsReader'
 class axdsReader:
     
 
-    def __init__(self, parallel=True, catalog_name=None, axds_type='platform2'):
+    def __init__(self, parallel=True, n_jobs=None, catalog_name=None, axds_type='platform2',
+                 cache_ttl=None, incremental=False, data_cache=False, catalog_ttl='1D', 
+                 data_columns=None):
         
         
         self.parallel = parallel
         
+        # number of workers to use when running in parallel
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        self.n_jobs = n_jobs
+        
+        # dataset_ids and metadata for a query are reused for cache_ttl
+        self.query_cache = QueryCache(ttl=cache_ttl)
+        
+        # keep data locally and only read in time intervals that aren't
+        # stored. With incremental, platform data is always checked for 
+        # rows after the last time stored.
+        self.data_cache = data_cache
+        self.incremental = incremental
+        
+        # columns of platform data to keep besides time, or None for all
+        self.data_columns = data_columns
+        
+        # why datasets could not be read in, by dataset_id, so they 
+        # aren't just missing from the data
+        self.failures = {}
+        
         # search Axiom database, version 2
         self.url_search_base = 'https://search.axds.co/v2/search?portalId=-1&page=1&pageSize=10000&verbose=true'
         self.url_docs_base = 'https://search.axds.co/v2/docs?verbose=true'
@@ -55,14 +86,13 @@ class axdsReader:
 
         self.approach = None
         
-        if catalog_name is None:
-            name = f'{pd.Timestamp.now().isoformat()}'
-            hash_name = hashlib.sha256(name.encode()).hexdigest()[:7]
-            self.catalog_name = os.path.join('..','catalogs', f'catalog_{hash_name}.yml')
-        else:
-            self.catalog_name = catalog_name
-            # if catalog_name already exists, read it in to save time
-            self.catalog
+        # the catalog is kept in memory and written to catalog_name if it 
+        # is given, otherwise to the catalog store under a hash of the 
+        # query. If catalog_name already exists, or the store has a 
+        # catalog for the query within catalog_ttl, it is read in on 
+        # first use instead of searching.
+        self.catalog_name = catalog_name
+        self.catalog_store = CatalogStore(max_age=catalog_ttl)
 
         
         # can be 'platform2' or 'layer_group'
@@ -78,6 +108,8 @@ class axdsReader:
         
         # name
         self.name = f'axds_{axds_type}'
+        
+        self.cache = DataCache(self.name)
 
         self.reader = 'axdsReader'
 
@@ -139,6 +171,47 @@ class axdsReader:
         return url
         
     
+    @property
+    def cache_key(self):
+        '''Key for this query in the query cache.'''
+        
+        # dataset_ids are part of the query if they were input
+        if (self.approach == 'stations') and (not self._stations):
+            dataset_ids = sorted(getattr(self, '_dataset_ids', []))
+        else:
+            dataset_ids = None
+        
+        return hash_query(reader=self.reader, axds_type=self.axds_type, 
+                          approach=self.approach, kw=self.kw, variables=self.variables,
+                          stations=self._stations, dataset_ids=dataset_ids)
+    
+    
+    def invalidate_cache(self):
+        '''Remove cached dataset_ids, metadata, and catalog for this query.
+        
+        The dataset_ids found for this query's stations are also removed 
+        from the station map so they are searched for again.
+        '''
+        
+        self.query_cache.invalidate(self.cache_key)
+        self.catalog_store.invalidate(self.cache_key)
+        if self._stations:
+            StationMap(self.name).invalidate(self._stations)
+    
+    
+    def validate(self):
+        '''Make sure variables are on the parameter list.
+        
+        This is run before the first search instead of when the reader 
+        is set up so that setting up the reader doesn't use the network.
+        '''
+        
+        if not getattr(self, '_validated', False):
+            if getattr(self, 'variables', None) is not None:
+                self.check_variables(self.variables)
+            self._validated = True
+    
+    
     @property
     def urls(self):
         '''make a list of urls for stations mode.
@@ -149,6 +222,8 @@ class axdsReader:
         
         if not hasattr(self, '_urls'):
             
+            self.validate()
+            
             if self.approach == 'region':
                 urls = []
                 if self.variables is not None:
@@ -165,9 +240,18 @@ class axdsReader:
             elif self.approach == 'stations':
                 urls = []
                 # if input stations instead of dataset_ids, using different urls here
-                if self._stations is not None:
+                if self._stations:
+                    # stations that were found before are read in by their ids
+                    found = StationMap(self.name).get(self._stations)
                     for station in self._stations:
-                        urls.append(self.url_builder(self.url_axds_type, query=station))
+                        if station in found:
+                            urls.extend([self.url_builder(self.url_docs_base, dataset_id=dataset_id) 
+                                         for dataset_id in found[station]])
+                    
+                    # search for the rest, and keep track of the url for each
+                    self._station_urls = {station: self.url_builder(self.url_axds_type, query=station)
+                                          for station in self._stations if station not in found}
+                    urls.extend(self._station_urls.values())
                 else:
                     for dataset_id in self._dataset_ids:
                         urls.append(self.url_builder(self.url_docs_base, dataset_id=dataset_id))
@@ -181,32 +265,51 @@ class axdsReader:
         
         if not hasattr(self, '_search_results'):
 
-            # loop over urls in case we have stations
+            # request all urls at once in case we have stations
+            responses = transport.get_many(self.urls, response='json', 
+                                           headers=self.search_headers, cache=True)
             search_results = []
-            for url in self.urls:
-                res = requests.get(url, headers=self.search_headers).json()
+            results_by_url = {}
+            for url, res in zip(self.urls, responses):
+                if isinstance(res, Exception):
+                    logger_axds.exception(res)
+                    logger_axds.warning(f'search url {url} did not work.')
+                    continue
                 # get different returns for an id docs grab vs. generic search
 #                 if isinstance(res, list):
 #                     res = res[0]
                 if isinstance(res, dict):
                     res = res['results']
                 search_results.extend(res)
+                results_by_url[url] = res
+            
+            # save the ids found for stations so they aren't searched for again
+            found = {station: [result['uuid'] for result in results_by_url[url]]
+                     for station, url in getattr(self, '_station_urls', {}).items() 
+                     if results_by_url.get(url)}
+            StationMap(self.name).update(found)
             # change search_results to a dictionary to remove
             # duplicate dataset_ids
             search_results_dict = {}
-            for search_result in search_results:
-                if self.axds_type == 'platform2':
+            if self.axds_type == 'platform2':
+                for search_result in search_results:
                     search_results_dict[search_result['uuid']] = search_result
 #                     search_results_dict[search_result['data']['uuid']] = search_result
-                if self.axds_type == 'layer_group':
-                    # switch to module search results instead of layer_group results
-                    module_uuid = search_result['data']['module_uuid']
-                    # don't repeat unnecessarily
-                    if module_uuid in search_results_dict.keys():
+            elif self.axds_type == 'layer_group':
+                # switch to module search results instead of layer_group results
+                # with each module only requested once, all at the same time
+                module_uuids = list(dict.fromkeys(search_result['data']['module_uuid'] 
+                                                  for search_result in search_results))
+                urls_module = [self.url_builder(self.url_docs_base, dataset_id=module_uuid) 
+                               for module_uuid in module_uuids]
+                responses = transport.get_many(urls_module, response='json', 
+                                               headers=self.search_headers, cache=True)
+                for module_uuid, url, res in zip(module_uuids, urls_module, responses):
+                    if isinstance(res, Exception):
+                        logger_axds.exception(res)
+                        logger_axds.warning(f'docs url {url} for module {module_uuid} did not work.')
                         continue
-                    else:
-                        url_module = self.url_builder(self.url_docs_base, dataset_id=module_uuid)
-                        search_results_dict[module_uuid] = requests.get(url_module, headers=self.search_headers).json()[0]
+                    search_results_dict[module_uuid] = res[0]
                         
             condition = (not search_results_dict == {})
             assertion = f'No datasets fit the input criteria of kw={self.kw} and variables={self.variables}'
@@ -222,7 +325,9 @@ class axdsReader:
         return self._search_results
     
     
-    def write_catalog_layer_group_entry(self, dataset, dataset_id, urlpath, layer_groups):
+    def layer_group_source(self, dataset, urlpath, layer_groups):
+        '''Catalog source spec for a module `dataset` read from `urlpath`.'''
+        
         try:
             model_slug = dataset['data']['model']['slug']
         except:
@@ -234,136 +339,181 @@ class axdsReader:
         except:
             label = dataset['data']['short_description'] 
 
-        geospatial_lat_min, geospatial_lat_max = dataset['data']['min_lat'], dataset['data']['max_lat']
-        geospatial_lon_min, geospatial_lon_max = dataset['data']['min_lng'], dataset['data']['max_lng']
-
-        lines = \
-f'''
-  {dataset_id}:
-    description: {label}
-    driver: opendap
-    args:
-      urlpath: {urlpath}    
-      engine: 'netcdf4'
-      xarray_kwargs:
-    metadata:
-      variables: {list(layer_groups.values())}
-      layer_group_uuids: {list(layer_groups.keys())}
-      model_slug: {model_slug}
-      geospatial_lon_min: {geospatial_lon_min}
-      geospatial_lat_min: {geospatial_lat_min}
-      geospatial_lon_max: {geospatial_lon_max}
-      geospatial_lat_max: {geospatial_lat_max}
-      time_coverage_start: {dataset['start_date_time']}
-      time_coverage_end: {dataset['end_date_time']}
-
-'''
-        return lines
-
-
+        metadata = {'variables': list(layer_groups.values()),
+                    'layer_group_uuids': list(layer_groups.keys()),
+                    'model_slug': model_slug,
+                    'geospatial_lon_min': dataset['data']['min_lng'],
+                    'geospatial_lat_min': dataset['data']['min_lat'],
+                    'geospatial_lon_max': dataset['data']['max_lng'],
+                    'geospatial_lat_max': dataset['data']['max_lat'],
+                    'time_coverage_start': dataset['start_date_time'],
+                    'time_coverage_end': dataset['end_date_time']}
+        
+        return {'description': label, 
+                'driver': 'intake_xarray.opendap.OpenDapSource',
+                'args': {'urlpath': urlpath, 'engine': 'netcdf4'},
+                'metadata': metadata}
+    
     
-    def write_catalog(self):
+    def opendap_urls(self, layer_group_uuids):
+        '''OPeNDAP url of each layer group, or '' if it doesn't have one.
         
-        # if the catalog already exists, don't do this
-        if os.path.exists(self.catalog_name):
-            return
+        Urls are kept on disk so each layer group is only looked up once. 
+        The ones that aren't known yet are looked up at the same time. 
+        Layer groups that couldn't be looked up are left out.
+        '''
         
-        else:
+        layer_group_uuids = list(dict.fromkeys(layer_group_uuids))
+        url_store = OpendapUrls(self.name)
+        urls = url_store.get(layer_group_uuids)
+        
+        todo = [uuid for uuid in layer_group_uuids if uuid not in urls]
+        docs_urls = [self.url_builder(self.url_docs_base, dataset_id=uuid) for uuid in todo]
+        responses = transport.get_many(docs_urls, response='json', 
+                                       headers=self.search_headers, cache=True)
+        found = {}
+        for layer_group_uuid, url, res in zip(todo, docs_urls, responses):
+            if isinstance(res, Exception):
+                logger_axds.exception(res)
+                logger_axds.warning(f'docs url {url} for layer_group {layer_group_uuid} did not work.')
+                continue
+            search_results_lg = res[0]
+            if 'OPENDAP' in search_results_lg['data']['access_methods']:
+                found[layer_group_uuid] = search_results_lg['source']['layers'][0]['thredds_opendap_url'][:-5]
+            else:
+                found[layer_group_uuid] = ''
+        
+        url_store.update(found)
+        urls.update(found)
+        return urls
+    
+    
+    def platform_sources(self):
+        '''Catalog source specs for platform2 search results.'''
+        
+        results = list(self.search_results.values())
         
-            f = open(self.catalog_name, "w")
+        # parse all the bounds at once
+        bounds = shapely.bounds(shapely.from_wkt([dataset['data']['geospatial_bounds'] 
+                                                  for dataset in results]))
+        
+        sources = {}
+        for dataset, (lon_min, lat_min, lon_max, lat_max) in zip(results, bounds.tolist()):
+            # variables that have a standard_name
+            metavars = dataset['source']['meta']['variables']
+            names = {key: metavar['attributes']['standard_name'] for key, metavar in metavars.items()
+                     if 'standard_name' in metavar.get('attributes', {})}
+            
+            metadata = {'variables': list(names.keys()),
+                        'standard_names': list(names.values()),
+                        'platform_category': dataset['data']['platform_category'],
+                        'geospatial_lon_min': lon_min,
+                        'geospatial_lat_min': lat_min,
+                        'geospatial_lon_max': lon_max,
+                        'geospatial_lat_max': lat_max,
+                        'id': dataset['data']['packrat_source_id'],
+                        'time_coverage_start': dataset['start_date_time'],
+                        'time_coverage_end': dataset['end_date_time']}
+            
+            sources[dataset['uuid']] = {'description': dataset['label'].replace(':','-'),
+                                        'driver': 'csv',
+                                        'args': {'urlpath': dataset['source']['files']['data.csv.gz']['url'],
+                                                 'csv_kwargs': {'parse_dates': ['time']}},
+                                        'metadata': metadata}
+        
+        return sources
+    
+    
+    def layer_group_sources(self):
+        '''Catalog source specs for layer_group search results.'''
+        
+        # look up the layer_groups of all modules at once
+        opendap_urls = self.opendap_urls([layer_group_uuid 
+                                          for dataset in self.search_results.values() 
+                                          for layer_group_uuid in dataset['data']['layer_group_info']])
+        
+        # catalog entries are by module uuid and unique to opendap urls
+        # dataset_ids are module uuids
+        sources = {}
+        for dataset_id, dataset in self.search_results.items():
+
+            # layer_groups associated with module
+            layer_groups = dataset['data']['layer_group_info']
+
+            urlpaths = []
+            for layer_group_uuid in layer_groups.keys():
+                urlpaths.append(opendap_urls.get(layer_group_uuid, ''))
+                if urlpaths[-1] == '':
+                    logger_axds.warning(f'no opendap url for module: module uuid {dataset_id}, layer_group uuid {layer_group_uuid}')
+                    # DO NOT STORE ITEM IN CATALOG IF NOT OPENDAP ACCESSIBLE
+                    continue
+
+            # there may be different urls for different layer_groups
+            # in which case associate the layer_group uuid with the dataset
+            # since the module uuid wouldn't be unique
+            if len(set(urlpaths)) > 1:
+                logger_axds.warning(f'there are multiple urls for module: module uuid {dataset_id}. urls: {set(urlpaths)}')
+                for urlpath, layer_group_uuid in zip(urlpaths,layer_groups.keys()):
+                    sources[layer_group_uuid] = self.layer_group_source(dataset, urlpath, layer_groups)
 
-            if self.axds_type == 'platform2':
-                lines = 'sources:\n'
-                for dataset_id, dataset in self.search_results.items():
-                    label = dataset['label'].replace(':','-')
-                    urlpath = dataset['source']['files']['data.csv.gz']['url']
-                    metavars = dataset['source']['meta']['variables']
-                    Vars, standard_names = zip(*[(key,metavars[key]['attributes']['standard_name']) for key in metavars.keys() if ('attributes' in metavars[key].keys()) and ('standard_name' in metavars[key]['attributes'])])
-                    P = shapely.wkt.loads(dataset['data']['geospatial_bounds'])
-                    geospatial_lon_min, geospatial_lat_min, geospatial_lon_max, geospatial_lat_max = P.bounds
-
-                    lines += \
-f'''
-  {dataset["uuid"]}:
-    description: {label}
-    driver: csv
-    args:
-      urlpath: {urlpath}    
-      csv_kwargs:
-        parse_dates: ['time']
-    metadata:
-      variables: {Vars}
-      standard_names: {standard_names}
-      platform_category: {dataset['data']['platform_category']}
-      geospatial_lon_min: {geospatial_lon_min}
-      geospatial_lat_min: {geospatial_lat_min}
-      geospatial_lon_max: {geospatial_lon_max}
-      geospatial_lat_max: {geospatial_lat_max}
-      id: {dataset["data"]["packrat_source_id"]}
-      time_coverage_start: {dataset['start_date_time']}
-      time_coverage_end: {dataset['end_date_time']}
-
-'''
+            else:
+                urlpath = list(set(urlpaths))[0]
+                # use module uuid
+                sources[dataset_id] = self.layer_group_source(dataset, urlpath, layer_groups)
+        
+        return sources
+    
+    
+    @property
+    def sources(self):
+        '''Catalog source specs by dataset_id.'''
+        
+        if not hasattr(self, '_sources'):
             
+            if self.axds_type == 'platform2':
+                self._sources = self.platform_sources()
             elif self.axds_type == 'layer_group':
-                lines = \
-'''
-plugins:
-  source:
-    - module: intake_xarray
-sources:
-'''            
-                # catalog entries are by module uuid and unique to opendap urls
-                # dataset_ids are module uuids
-                for dataset_id, dataset in self.search_results.items():
-
-                    # layer_groups associated with module
-                    layer_groups = dataset['data']['layer_group_info']
-
-                    # get search results for layer_groups
-                    urlpaths = []
-                    for layer_group_uuid in layer_groups.keys():
-                        url_layer_group = self.url_builder(self.url_docs_base, dataset_id=layer_group_uuid)
-                        search_results_lg = requests.get(url_layer_group, headers=self.search_headers).json()[0]
-
-                        if 'OPENDAP' in search_results_lg['data']['access_methods']:
-                            urlpaths.append(search_results_lg['source']['layers'][0]['thredds_opendap_url'][:-5])
-                        else:
-                            urlpaths.append('')
-                            logger_axds.warning(f'no opendap url for module: module uuid {dataset_id}, layer_group uuid {layer_group_uuid}')
-                            # DO NOT STORE ITEM IN CATALOG IF NOT OPENDAP ACCESSIBLE
-                            continue
-
-                    # there may be different urls for different layer_groups
-                    # in which case associate the layer_group uuid with the dataset
-                    # since the module uuid wouldn't be unique
-                    if len(set(urlpaths)) > 1:
-                        logger_axds.warning(f'there are multiple urls for module: module uuid {dataset_id}. urls: {set(urlpaths)}')
-                        for urlpath, layer_group_uuid in zip(urlpaths,layer_groups.keys()):
-                            lines += self.write_catalog_layer_group_entry(dataset, layer_group_uuid, urlpath, layer_groups)
-
-                    else:
-                        urlpath = list(set(urlpaths))[0]
-                        # use module uuid
-                        lines += self.write_catalog_layer_group_entry(dataset, dataset_id, urlpath, layer_groups)
-
-            f.write(lines)
-            f.close()
+                self._sources = self.layer_group_sources()
+        
+        return self._sources
+    
+    
+    def write_catalog(self, path=None):
+        '''Write the catalog to `path`, or `catalog_name`, as YAML.'''
+        
+        export_catalog(self.sources, path or self.catalog_name)
                     
     
     @property
     def catalog(self):
+        '''Intake catalog of the search results, built in memory.
+        
+        If `catalog_name` is given, an existing catalog there is read in 
+        instead of searching, and otherwise the catalog is also written 
+        there. Without `catalog_name`, the catalog for the same query 
+        is reused from the catalog store.
+        '''
         
         if not hasattr(self, '_catalog'):
             
-            self.write_catalog()
-            # if we already know there aren't any dataset_ids
-            # don't try to read catalog
-            if (not self.search_results == {}):
-#             if (not self.dataset_ids == []) or (not self.search_results == {}):
+            # an existing catalog is read in without searching
+            if (self.catalog_name is not None) and os.path.exists(self.catalog_name):
                 catalog = intake.open_catalog(self.catalog_name)
-            else:
+            
+            elif (self.catalog_name is None) and self.catalog_store.has(self.cache_key):
+                catalog = intake.open_catalog(self.catalog_store.path(self.cache_key))
+            
+            # if we already know there aren't any dataset_ids
+            # don't make a catalog
+            elif self.search_results == {}:
                 catalog = None
+            
+            else:
+                catalog = make_catalog(self.sources, name=self.name)
+                if self.catalog_name is not None:
+                    self.write_catalog()
+                else:
+                    self.catalog_store.set(self.cache_key, self.sources)
             self._catalog = catalog
             
         return self._catalog
@@ -373,11 +523,15 @@ sources:
     def dataset_ids(self):
         '''Find dataset_ids for server.'''
         
+        if (not hasattr(self, '_dataset_ids')) and self.query_cache.has(self.cache_key, 'dataset_ids'):
+            self._dataset_ids = self.query_cache.get(self.cache_key, 'dataset_ids')
+        
         if not hasattr(self, '_dataset_ids'):
             if self.catalog is not None:
                 self._dataset_ids = list(self.catalog)
             else:
                 self._dataset_ids = []
+            self.query_cache.set(self.cache_key, 'dataset_ids', self._dataset_ids)
                 
         return self._dataset_ids
         
@@ -392,6 +546,9 @@ sources:
     def meta(self):
         '''Rearrange the individual metadata into a dataframe.'''
         
+        if (not hasattr(self, '_meta')) and self.query_cache.has(self.cache_key, 'meta'):
+            self._meta = self.query_cache.get(self.cache_key, 'meta')
+        
         if not hasattr(self, '_meta'):
             
             data = []
@@ -403,53 +560,111 @@ sources:
                 self._meta = pd.DataFrame(index=self.dataset_ids, columns=columns, data=data)
             else:
                 self._meta = None
+            self.query_cache.set(self.cache_key, 'meta', self._meta)
            
         return self._meta       
     
     
+    def read_cached(self, dataset_id):
+        '''Read in platform data for `dataset_id` through the data cache.
+        
+        The data file can't be requested for a time range. If the stored 
+        data doesn't cover `kw`, or always with `incremental`, the file is
+        only downloaded again if the server says it changed since last 
+        time, and then only its rows after the last time stored are added.
+        '''
+        
+        min_time, max_time = utc_timestamp(self.kw['min_time']), utc_end(self.kw['max_time'])
+        urlpath = self.catalog[dataset_id].urlpath
+        key = hash_query(urlpath=urlpath)
+        
+        if self.incremental or missing_intervals(self.cache.coverage(key), min_time, max_time):
+            validators = self.cache.state(key).get('validators')
+            content, validators = transport.get_if_changed(urlpath, validators)
+            if content is not None:
+                # only rows from the last time stored on are kept as it's read
+                last = self.cache.last_time(key)
+                data = read_csv_window(gzip.GzipFile(fileobj=io.BytesIO(content)), start=last)
+                if last is not None:
+                    data = data[data.index > last]
+                self.cache.write(key, data)
+                self.cache.set_state(key, dict(self.cache.state(key), validators=validators))
+            
+            # the file has all of the data up to now
+            now = pd.Timestamp.now(tz='UTC')
+            self.cache.add_coverage(key, [(min_time, min(max_time, now))])
+        
+        data = self.cache.read(key, min_time, max_time)
+        # nothing is stored within kw, like for a file without rows then
+        return empty_frame() if data is None else data
+    
+    
+    def read_platform(self, dataset_id):
+        '''Read in platform data for `dataset_id` within `kw` as it streams.
+        
+        The file is decompressed and parsed in blocks so rows outside 
+        of `kw` aren't kept, and reading stops after `max_time` if the 
+        file is in time order.
+        '''
+        
+        with fsspec.open(self.catalog[dataset_id].urlpath, 'rb', compression='infer') as f:
+            return read_csv_window(f, self.kw['min_time'], self.kw['max_time'], 
+                                   columns=self.data_columns)
+    
+    
+    def read_cached_grid(self, dataset_id, data, timekey):
+        '''Read in `data` for `dataset_id` through the data cache.
+        
+        `data` is the lazily opened dataset with time dimension `timekey`. 
+        Only the time intervals within `kw` that aren't stored are loaded.
+        '''
+        
+        min_time, max_time = utc_timestamp(self.kw['min_time']), utc_end(self.kw['max_time'])
+        key = hash_query(urlpath=self.catalog[dataset_id].urlpath)
+        
+        now = pd.Timestamp.now(tz='UTC')
+        for start, end in missing_intervals(self.cache.coverage(key), min_time, max_time):
+            piece = data.sel({timekey: slice(start.tz_localize(None), end.tz_localize(None))})
+            self.cache.write(key, piece.load(), dim=timekey)
+            self.cache.add_coverage(key, [(start, min(end, now))])
+        
+        return self.cache.read(key, min_time, max_time, dim=timekey)
+    
+    
     def data_by_dataset(self, dataset_id):
         
         if self.axds_type == 'platform2':
 
-            # .to_dask().compute() seems faster than read but 
-            # should do more comparisons
-            data = self.catalog[dataset_id].to_dask().compute()
-            data = data.set_index('time')
-            data = data[self.kw['min_time']:self.kw['max_time']]
+            try:
+                if self.data_cache or self.incremental:
+                    data = self.read_cached(dataset_id)
+                    if self.data_columns is not None:
+                        data = data[[col for col in data.columns if col in self.data_columns]]
+                else:
+                    data = self.read_platform(dataset_id)
+                data = data[self.kw['min_time']:self.kw['max_time']]
+            except Exception as e:
+                logger_axds.exception(e)
+                self.failures[dataset_id] = repr(e)
+                logger_axds.warning(f'data was not read in for dataset_id {dataset_id} with url path {self.catalog[dataset_id].urlpath}.')
+                data = None
             
         elif self.axds_type == 'layer_group':
             
             if self.catalog[dataset_id].urlpath is not None:
                 try:
                     data = self.catalog[dataset_id].to_dask()
-                    try:
-                        timekey = [coord for coord in data.coords if ('standard_name' in data[coord].attrs) and (data[coord].attrs['standard_name'] == 'time')]
-                        assert len(timekey) > 0
-                    except:
-                        timekey = [coord for coord in data.coords if ('time' in coord) or (coord=='t')]
-                        assert len(timekey) > 0
-                    timekey = timekey[0]
-                    slicedict = {timekey: slice(self.kw['min_time'],self.kw['max_time'])}
-                    data = data.sel(slicedict)
-                except KeyError as e:
-#                     logger_axds.exception(e)
-#                     logger_axds.warning(f'data was not read in for dataset_id {dataset_id} with url path {self.catalog[dataset_id].urlpath} and description {self.catalog[dataset_id].description}.')
-
-                    # try to fix key error assuming it is the following problem:
-                    # KeyError: "cannot represent labeled-based slice indexer for dimension 'time' with a slice over integer positions; the index is unsorted or non-unique"
-                    try:
-                        timekey = [coord for coord in data.coords if ('standard_name' in data[coord].attrs) and (data[coord].attrs['standard_name'] == 'time')]
-                        assert len(timekey) > 0
-                    except:
-                        timekey = [coord for coord in data.coords if ('time' in coord) or (coord=='t')]
-                        assert len(timekey) > 0
-                    timekey = timekey[0]
-
-                    slicedict = {timekey: slice(self.kw['min_time'],self.kw['max_time'])}
-                    _, index = np.unique(data[timekey], return_index=True)
-                    data = data.isel({timekey: index}).sel(slicedict)
+                    timekey = time_key(data)
+                    # the time coordinate can be out of order or repeat, 
+                    # which only matters inside of the time window, and 
+                    # only the window is read in remotely
+                    index = time_indexer(data[timekey].values, self.kw['min_time'], self.kw['max_time'])
+                    data = data.isel({timekey: index})
+                    if self.data_cache:
+                        data = self.read_cached_grid(dataset_id, data, timekey)
                 except Exception as e:
                     logger_axds.exception(e)
+                    self.failures[dataset_id] = repr(e)
                     logger_axds.warning(f'data was not read in for dataset_id {dataset_id} with url path {self.catalog[dataset_id].urlpath} and description {self.catalog[dataset_id].description}.')
                     data = None
             else:
@@ -466,8 +681,8 @@ sources:
         if not hasattr(self, '_data'):
             
             if self.parallel:
-                num_cores = multiprocessing.cpu_count()
-                downloads = Parallel(n_jobs=num_cores)(
+                # threads so failures are recorded on this reader
+                downloads = Parallel(n_jobs=self.n_jobs, prefer='threads')(
                     delayed(self.data_by_dataset)(dataset_id) for dataset_id in self.dataset_ids
                 )
             else:
@@ -485,38 +700,54 @@ sources:
         return self._data
     
     
-    def all_variables(self):
-        '''Not relevant for layer_group'''
+    def all_variables(self, max_age=None):
+        '''Return the Axiom parameter groups with their number of datasets.
+        
+        Not relevant for layer_group. The parameter groups are stored 
+        locally and requested again once the store is older than `max_age`
+        (seconds or a string like "7D"). With `max_age=None`, a store that 
+        exists is always used. Only one process refreshes the store at a 
+        time.
+        '''
+        
+        store = VariableStore('axds_platform2')
+        variables = store.load()
         
-        fname = "parameter_group_names.txt"
+        # counts from before there was a store
         csv_fname = 'axds_platform2_variable_list.csv'
-        # read in Axiom Search parameter group names
-        # save to file
-        if not os.path.exists(csv_fname):
-            os.system('curl -sSL -H "Accept: application/json" "https://search.axds.co/v2/search" | jq -r \'.tags["Parameter Group"][] | "\(.label) \(.count)"\' > parameter_group_names.txt')
-        
-            # read in parameter group names
-            f = open(fname, "r")
-            parameters_temp = f.readlines()
-            f.close()
-    #         parameters = [parameter.strip('\n') for parameter in parameters]
-            parameters = {}
-            for parameter in parameters_temp:
-                parts = parameter.strip('\n').split()
-                name = ' '.join(parts[:-1])
-                count = parts[-1]
-                parameters[name] = count
-
-            df = pd.DataFrame()
-            df['variable'] = parameters.keys()
-            df['count'] = parameters.values()
-            df = df.set_index('variable')
-            df.to_csv(csv_fname)
+        if (variables is None) and os.path.exists(csv_fname):
+            variables = pd.read_csv(csv_fname, index_col='variable')
+            variables['refreshed'] = os.path.getmtime(csv_fname)
+            store.save(variables)
+        
+        if isinstance(max_age, str):
+            max_age = pd.Timedelta(max_age).total_seconds()
+        
+        def fresh(variables):
+            return (variables is not None) and ((max_age is None) or (time.time() - store.refreshed < max_age))
+        
+        if fresh(variables):
+            return variables[['count']]
+        
+        with store.lock():
+            # another process may have refreshed it while we waited
+            variables = store.load()
+            if fresh(variables):
+                return variables[['count']]
             
-        else:
-            df = pd.read_csv(csv_fname, index_col='variable')
+            # counts of parameter groups are tags of a search for everything
+            url = 'https://search.axds.co/v2/search'
+            tags = transport.get(url, response='json', headers=self.search_headers, 
+                                 cache=True)['tags']['Parameter Group']
+            variables = pd.DataFrame(index=pd.Index([tag['label'] for tag in tags], name='variable'),
+                                     data={'count': [int(tag['count']) for tag in tags], 
+                                           'refreshed': time.time()})
+            store.save(variables)
+        
+        # indexes of names were built from the old counts
+        reset_indexes()
             
-        return df
+        return variables[['count']]
         
     
     def search_variables(self, variables):
@@ -526,24 +757,11 @@ sources:
         Call with `search_variables('salinity')` to return relevant names.
         '''
         
-        if not isinstance(variables, list):
-            variables = [variables]
+        # the index of names is built once per process
+        index = get_index(self.name, lambda: {self.name: self.all_variables()})
         
-        # set up search for input variables
-        search = f"(?i)"
-        for variable in variables:
-            search += f".*{variable}|"
-        search = search.strip('|')
-
-        r = re.compile(search)
-        
-        df = self.all_variables()
-        parameters = df.index
-
-        matches = list(filter(r.match, parameters))
-
         # return parameters that match input variable strings
-        return df.loc[matches].sort_values('count', ascending=False)        
+        return index.search(variables)[['count']]        
 
     
     def check_variables(self, variables, verbose=False):
@@ -556,22 +774,24 @@ sources:
         if not isinstance(variables, list):
             variables = [variables]
             
-        parameters = list(self.all_variables().index)
+        parameters = set(self.all_variables().index)
         
         # for a variable to exactly match a parameter 
         # this should equal 1
         count = []
         for variable in variables:
-            count += [parameters.count(variable)]
+            count += [int(variable in parameters)]
         
         condition = np.allclose(count,1)
         
-        assertion = f'The input variables are not exact matches to parameter groups. \
-                     \nCheck all parameter group values with `axdsReader().all_variables()` \
-                     \nor search parameter group values with `axdsReader().search_variables({variables})`.\
-                     \n\n Try some of the following variables:\n{str(self.search_variables(variables))}'
+        # only search for suggestions if there is a problem
+        if not condition:
+            assertion = f'The input variables are not exact matches to parameter groups. \
+                         \nCheck all parameter group values with `axdsReader().all_variables()` \
+                         \nor search parameter group values with `axdsReader().search_variables({variables})`.\
+                         \n\n Try some of the following variables:\n{str(self.search_variables(variables))}'
 
-        assert condition, assertion
+            assert condition, assertion
         
         if condition and verbose:
             print('all variables are matches!')
@@ -585,6 +805,12 @@ class region(axdsReader):
     def __init__(self, kwargs):
         ax_kwargs = {'catalog_name': kwargs.get('catalog_name', None),
                      'parallel': kwargs.get('parallel', True),
+                     'n_jobs': kwargs.get('n_jobs', None),
+                     'cache_ttl': kwargs.get('cache_ttl', None),
+                     'catalog_ttl': kwargs.get('catalog_ttl', '1D'),
+                     'incremental': kwargs.get('incremental', False),
+                     'data_cache': kwargs.get('data_cache', False),
+                     'data_columns': kwargs.get('data_columns', None),
                      'axds_type': kwargs.get('axds_type', 'platform2')
                     }
         axdsReader.__init__(self, **ax_kwargs)
@@ -611,11 +837,8 @@ class region(axdsReader):
         if (variables is not None) and (not isinstance(variables, list)):
             variables = [variables]
             
-        # make sure variables are on parameter list
-        if variables is not None:
-            self.check_variables(variables)
-            
-            
+        # variables are checked against the parameter list on first
+        # use in `validate` since that can require a download
         self.variables = variables
 #         # DOESN'T CURRENTLY LIMIT WHICH VARIABLES WILL BE FOUND ON EACH SERVER
         
@@ -642,6 +865,12 @@ class stations(axdsReader):
     def __init__(self, kwargs):
         ax_kwargs = {'catalog_name': kwargs.get('catalog_name', None),
                      'parallel': kwargs.get('parallel', True),
+                     'n_jobs': kwargs.get('n_jobs', None),
+                     'cache_ttl': kwargs.get('cache_ttl', None),
+                     'catalog_ttl': kwargs.get('catalog_ttl', '1D'),
+                     'incremental': kwargs.get('incremental', False),
+                     'data_cache': kwargs.get('data_cache', False),
+                     'data_columns': kwargs.get('data_columns', None),
                      'axds_type': kwargs.get('axds_type', 'platform2')}
         axdsReader.__init__(self, **ax_kwargs)
         
@@ -0,0 +1,326 @@
+'''On-disk caches shared by the readers.'''
+
+import os
+import time
+import threading
+import json
+import pickle
+import hashlib
+import shutil
+import numpy as np
+import pandas as pd
+import xarray as xr
+from search.utils import merge_intervals
+
+
+def hash_query(**query):
+    '''Hash of query parameters that doesn't depend on their order.'''
+
+    normalized = json.dumps(query, sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def write_atomic(path, content, mode='wb'):
+    '''Write `content` to `path` so that readers never see a partial file.'''
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, mode) as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+class QueryCache:
+    '''Cache results of a query, like dataset_ids and metadata, on disk.
+
+    Entries are stored under a hash of the query and are used for `ttl`
+    after they are written.
+
+    Parameters
+    ----------
+    ttl: int, float, str, or None
+        How long entries are used for, in seconds or as a string that
+        `pd.Timedelta` understands like "1D". `None` or 0 turns off the
+        cache.
+    cache_dir: str
+        Directory to store entries in.
+    '''
+
+    def __init__(self, ttl=None, cache_dir=os.path.join('..', 'cache', 'queries')):
+
+        if isinstance(ttl, str):
+            ttl = pd.Timedelta(ttl).total_seconds()
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+
+
+    @property
+    def enabled(self):
+        return (self.ttl is not None) and (self.ttl > 0)
+
+
+    def path(self, key, name):
+        return os.path.join(self.cache_dir, f'{key[:16]}_{name}.pkl')
+
+
+    def has(self, key, name):
+        '''Whether there is an entry `name` for query `key` within ttl.'''
+
+        if not self.enabled:
+            return False
+
+        path = self.path(key, name)
+        return os.path.exists(path) and (time.time() - os.path.getmtime(path) < self.ttl)
+
+
+    def get(self, key, name):
+
+        with open(self.path(key, name), 'rb') as f:
+            return pickle.load(f)
+
+
+    def set(self, key, name, value):
+
+        if self.enabled:
+            write_atomic(self.path(key, name), pickle.dumps(value))
+
+
+    def invalidate(self, key=None):
+        '''Remove entries for query `key`, or all entries if `key` is None.'''
+
+        if not os.path.exists(self.cache_dir):
+            return
+
+        for fname in os.listdir(self.cache_dir):
+            if (key is None) or fname.startswith(f'{key[:16]}_'):
+                os.remove(os.path.join(self.cache_dir, fname))
+
+
+class StationMap:
+    '''Dataset ids found for station names on one server, stored on disk.
+
+    A station only has to be searched for the first time it is used on a
+    server. The map is a json file of the ids found for each station.
+
+    Parameters
+    ----------
+    name: str
+        Name of the server, like "erddap_ioos".
+    cache_dir: str
+        Directory to store the maps in.
+    '''
+
+    _lock = threading.Lock()
+
+    def __init__(self, name, cache_dir=os.path.join('..', 'cache', 'stations')):
+
+        self.name = name
+        self.path = os.path.join(cache_dir, f'{name}.json')
+
+
+    def load(self):
+
+        if not os.path.exists(self.path):
+            return {}
+
+        with open(self.path) as f:
+            return json.load(f)
+
+
+    def get(self, stations):
+        '''Ids of the `stations` that are in the map.'''
+
+        mapping = self.load()
+        return {station: mapping[station] for station in stations if station in mapping}
+
+
+    def update(self, found):
+        '''Add the ids in `found` for each station to the map.'''
+
+        if len(found) == 0:
+            return
+
+        # read again in case another reader added stations
+        with StationMap._lock:
+            mapping = self.load()
+            mapping.update(found)
+            write_atomic(self.path, json.dumps(mapping, indent=1, sort_keys=True), mode='w')
+
+
+    def invalidate(self, stations=None):
+        '''Remove `stations` from the map, or all stations if None.'''
+
+        with StationMap._lock:
+            if stations is None:
+                mapping = {}
+            else:
+                mapping = {station: ids for station, ids in self.load().items() 
+                           if station not in stations}
+            write_atomic(self.path, json.dumps(mapping, indent=1, sort_keys=True), mode='w')
+
+
+class OpendapUrls(StationMap):
+    '''OPeNDAP url of each Axiom layer group, stored on disk.
+
+    A layer group only has to be looked up the first time it is in a 
+    catalog. Layer groups that can't be read with OPeNDAP have an empty 
+    url.
+
+    Parameters
+    ----------
+    name: str
+        Name of the server, like "axds_layer_group".
+    cache_dir: str
+        Directory to store the urls in.
+    '''
+
+    def __init__(self, name, cache_dir=os.path.join('..', 'cache', 'opendap_urls')):
+
+        super().__init__(name, cache_dir=cache_dir)
+
+
+class DataCache:
+    '''Data read in for each dataset, stored on disk by time.
+
+    There is a directory for each dataset and query. Tables are stored in 
+    a parquet file for each month and grids in a zarr store for each time
+    range that was read in. The state of each entry, like the time 
+    intervals that have been read in, is in state.json so only missing 
+    intervals need to be requested.
+
+    Parameters
+    ----------
+    name: str
+        Name of the server, like "erddap_ioos".
+    cache_dir: str
+        Directory to store data in, in a directory for each server.
+    '''
+
+    def __init__(self, name, cache_dir=os.path.join('..', 'cache', 'data')):
+
+        self.name = name
+        self.cache_dir = os.path.join(cache_dir, name)
+
+
+    def path(self, key, *parts):
+        return os.path.join(self.cache_dir, key[:16], *parts)
+
+
+    def state(self, key):
+        '''State of the entry for `key`, like its coverage and last time.'''
+
+        if not os.path.exists(self.path(key, 'state.json')):
+            return {}
+
+        with open(self.path(key, 'state.json')) as f:
+            return json.load(f)
+
+
+    def set_state(self, key, state):
+
+        write_atomic(self.path(key, 'state.json'), json.dumps(state, default=str), mode='w')
+
+
+    def coverage(self, key):
+        '''Time intervals that have been read in for `key`.'''
+
+        return [(pd.Timestamp(start), pd.Timestamp(end)) 
+                for start, end in self.state(key).get('coverage', [])]
+
+
+    def add_coverage(self, key, intervals):
+
+        state = self.state(key)
+        state['coverage'] = merge_intervals(self.coverage(key) + list(intervals))
+        self.set_state(key, state)
+
+
+    def last_time(self, key):
+        '''Last time in the stored data for `key`, or None.'''
+
+        last = self.state(key).get('last')
+        return None if last is None else pd.Timestamp(last)
+
+
+    def write(self, key, data, dim='time'):
+        '''Add `data` to the entry for `key`.
+
+        `data` is a DataFrame with a UTC time index or a Dataset with 
+        time dimension `dim`.
+        '''
+
+        if isinstance(data, pd.DataFrame):
+            if len(data) == 0:
+                return
+            last = data.index.max()
+            for month, part in data.groupby(data.index.strftime('%Y-%m')):
+                path = self.path(key, f'{month}.parquet')
+                if os.path.exists(path):
+                    part = pd.concat([pd.read_parquet(path), part])
+                    # rows on the edges of intervals can be read in twice
+                    part = part[~part.reset_index().duplicated(keep='last').values]
+                    part = part.sort_index(kind='stable')
+                write_atomic(path, part.to_parquet())
+
+        else:
+            if data.sizes.get(dim, 0) == 0:
+                return
+            times = pd.to_datetime(data[dim].values)
+            last = times.max()
+            name = f'{times.min():%Y%m%dT%H%M%S}_{last:%Y%m%dT%H%M%S}_{os.getpid()}.zarr'
+            temp_path = self.path(key, f'{name}.tmp')
+            # encoding from the source, like chunks, doesn't apply to zarr
+            data = data.copy()
+            for var in data.variables.values():
+                var.encoding = {}
+            data.to_zarr(temp_path, mode='w')
+            os.replace(temp_path, self.path(key, name))
+
+        state = self.state(key)
+        if (state.get('last') is None) or (last > pd.Timestamp(state['last'])):
+            state['last'] = last
+            self.set_state(key, state)
+
+
+    def read(self, key, start=None, end=None, dim='time'):
+        '''Stored data for `key` between `start` and `end`, or None.'''
+
+        if not os.path.exists(self.path(key)):
+            return None
+
+        fnames = sorted(os.listdir(self.path(key)))
+        tables = [fname for fname in fnames if fname.endswith('.parquet')]
+        grids = [fname for fname in fnames if fname.endswith('.zarr')]
+
+        if len(tables) > 0:
+            # only read in the months that are needed
+            if start is not None:
+                tables = [fname for fname in tables if fname[:7] >= f'{pd.Timestamp(start):%Y-%m}']
+            if end is not None:
+                tables = [fname for fname in tables if fname[:7] <= f'{pd.Timestamp(end):%Y-%m}']
+            if len(tables) == 0:
+                return None
+            data = pd.concat([pd.read_parquet(self.path(key, fname)) for fname in tables])
+            if start is not None:
+                data = data[data.index >= start]
+            if end is not None:
+                data = data[data.index <= end]
+            return data
+
+        elif len(grids) > 0:
+            datasets = [xr.open_zarr(self.path(key, fname)) for fname in grids]
+            data = xr.concat(datasets, dim=dim).sortby(dim)
+            _, index = np.unique(data[dim], return_index=True)
+            data = data.isel({dim: index})
+            return data.sel({dim: slice(None if start is None else pd.Timestamp(start).tz_localize(None),
+                                        None if end is None else pd.Timestamp(end).tz_localize(None))})
+
+        return None
+
+
+    def invalidate(self, key=None):
+        '''Remove data for `key`, or all data for the server if `key` is None.'''
+
+        path = self.cache_dir if key is None else self.path(key)
+        if os.path.exists(path):
+            shutil.rmtree(path)
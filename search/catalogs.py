@@ -0,0 +1,155 @@
+'''Intake catalogs built in memory from source specs.
+
+A source spec is a dict with the description, driver, args, and metadata
+of a catalog entry, the same as under `sources:` in a catalog file. The
+readers build these from search results, so a catalog file is only 
+written to be reused, by `CatalogStore` for the same query or to a 
+`catalog_name` that was asked for.
+'''
+
+import os
+import re
+import time
+import json
+import yaml
+import pandas as pd
+from intake.catalog import Catalog
+from intake.catalog.local import LocalCatalogEntry
+from search.cache import write_atomic
+
+
+def make_catalog(sources, name=None):
+    '''Intake catalog of `sources`, a dict of source spec by entry name.'''
+
+    entries = {entry_name: LocalCatalogEntry(name=entry_name, direct_access=True,
+                                             description=spec.get('description', ''),
+                                             driver=spec['driver'], args=spec.get('args', {}),
+                                             metadata=spec.get('metadata', {}))
+               for entry_name, spec in sources.items()}
+
+    return Catalog.from_dict(entries, name=name)
+
+
+def export_catalog(sources, path):
+    '''Write `sources` to `path` as a catalog file for `intake.open_catalog`.'''
+
+    text = yaml.safe_dump({'sources': sources}, default_flow_style=False, sort_keys=False)
+    write_atomic(path, text, mode='w')
+
+
+class CatalogStore:
+    '''Catalog files named by a hash of the query that made them.
+
+    A query that was already run reads in its catalog instead of searching
+    again. Catalogs older than `max_age` are not used. Each catalog is 
+    written with the `max_age` of the store that wrote it, and when a new
+    one is written, catalogs past their own `max_age` are removed, then 
+    the oldest until the store is within `max_size`. Only files named by
+    the store are removed, not other catalogs in `cache_dir`.
+
+    Parameters
+    ----------
+    max_age: int, float, str, or None
+        How long catalogs are used for, in seconds or as a string that 
+        `pd.Timedelta` understands like "1D". `None` or 0 turns off the 
+        store.
+    max_size: int
+        Number of bytes of catalogs to keep.
+    cache_dir: str
+        Directory to store catalogs in.
+    '''
+
+    def __init__(self, max_age='1D', max_size=50e6, cache_dir=os.path.join('..', 'catalogs')):
+
+        if isinstance(max_age, str):
+            max_age = pd.Timedelta(max_age).total_seconds()
+        self.max_age = max_age
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+
+
+    @property
+    def enabled(self):
+        return (self.max_age is not None) and (self.max_age > 0)
+
+
+    # names of catalog files written by a store
+    pattern = re.compile(r'catalog_[0-9a-f]{16}\.yml')
+
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'catalog_{key[:16]}.yml')
+
+
+    @staticmethod
+    def info_path(path):
+        '''File next to catalog `path` with the max_age it was written with.'''
+
+        return f'{os.path.splitext(path)[0]}.json'
+
+
+    def has(self, key):
+        '''Whether there is a catalog for query `key` within `max_age`.'''
+
+        if not self.enabled:
+            return False
+
+        path = self.path(key)
+        return os.path.exists(path) and (time.time() - os.path.getmtime(path) < self.max_age)
+
+
+    def set(self, key, sources):
+        '''Write `sources` as the catalog for query `key`.'''
+
+        if self.enabled:
+            export_catalog(sources, self.path(key))
+            write_atomic(self.info_path(self.path(key)), json.dumps({'max_age': self.max_age}), mode='w')
+            self.evict()
+
+
+    def invalidate(self, key):
+        '''Remove the catalog for query `key`.'''
+
+        for path in [self.path(key), self.info_path(self.path(key))]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    def written_max_age(self, path):
+        '''max_age that catalog `path` was written with.'''
+
+        try:
+            with open(self.info_path(path)) as f:
+                return json.load(f)['max_age']
+        except (OSError, ValueError, KeyError):
+            # written before max_age was kept with each catalog
+            return self.max_age
+
+
+    def evict(self):
+        '''Remove catalogs past their `max_age`, then the oldest past `max_size`.'''
+
+        if not os.path.exists(self.cache_dir):
+            return
+
+        now = time.time()
+        catalogs = []
+        for fname in os.listdir(self.cache_dir):
+            if self.pattern.fullmatch(fname):
+                path = os.path.join(self.cache_dir, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                catalogs.append((stat.st_mtime, stat.st_size, self.written_max_age(path), path))
+
+        size = sum(entry[1] for entry in catalogs)
+        for mtime, catalog_size, max_age, path in sorted(catalogs):
+            if (now - mtime < max_age) and (size <= self.max_size):
+                continue
+            for remove_path in [path, self.info_path(path)]:
+                try:
+                    os.remove(remove_path)
+                except OSError:
+                    pass
+            size -= catalog_size
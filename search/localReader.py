@@ -2,9 +2,10 @@ import logging
 import os
 import intake
 import pandas as pd
-import hashlib
 from joblib import Parallel, delayed
 import multiprocessing
+from search.catalogs import make_catalog, export_catalog, CatalogStore
+from search.cache import hash_query
 
 os.makedir("../catalogs", exist_ok=True)  # succeeds even if directory exists.
 
@@ -35,18 +36,22 @@ reader = 'localReader'
 class localReader:
     
 
-    def __init__(self, parallel=True, catalog_name=None, filenames=None, kw=None):
+    def __init__(self, parallel=True, n_jobs=None, catalog_name=None, filenames=None, kw=None, 
+                 catalog_ttl='1D'):
 
         self.parallel = parallel
-
-        if catalog_name is None:
-            name = f'{pd.Timestamp.now().isoformat()}'
-            hash_name = hashlib.sha256(name.encode()).hexdigest()[:7]
-            self.catalog_name = os.path.join('..','catalogs', f'catalog_{hash_name}.yml')
-        else:
-            self.catalog_name = catalog_name
-            # if catalog_name already exists, read it in to save time
-            self.catalog
+        
+        # number of workers to use when running in parallel
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        self.n_jobs = n_jobs
+
+        # the catalog is kept in memory and written to catalog_name if it 
+        # is given, otherwise to the catalog store under a hash of the 
+        # files. If catalog_name already exists, or the store has a 
+        # catalog for the same unchanged files, it is read in on first use.
+        self.catalog_name = catalog_name
+        self.catalog_store = CatalogStore(max_age=catalog_ttl)
 
         if (filenames is not None) and (not isinstance(filenames, list)):
             filenames = [filenames]
@@ -57,6 +62,9 @@ class localReader:
             
         self.kw = kw
         
+        # why datasets could not be read in, by dataset_id
+        self.failures = {}
+        
         if (filenames == None) and (catalog_name == None):
             self._dataset_ids = []
             logger_local.warning('no datasets for localReader with catalog_name {catalog_name} and filenames {filenames}.')
@@ -68,52 +76,76 @@ class localReader:
 
 
     
-    def write_catalog(self):
+    @property
+    def cache_key(self):
+        '''Key for these files, which changes if they are modified.'''
         
-        # if the catalog already exists, don't do this
-        if os.path.exists(self.catalog_name):
-            return
+        files = []
+        for filename in self.filenames:
+            stat = os.stat(filename)
+            files.append([os.path.abspath(filename), stat.st_mtime_ns, stat.st_size])
         
-        else:
-            lines = 'sources:\n'
-
+        return hash_query(reader=self.reader, files=files)
+    
+    
+    @property
+    def sources(self):
+        '''Catalog source specs by file name.'''
+        
+        if not hasattr(self, '_sources'):
+            
+            sources = {}
             for filename in self.filenames:
 
                 if 'csv' in filename:
-                    file_intake = intake.open_csv(filename)
-                    data = file_intake.read()
+                    driver = 'csv'
+                    data = intake.open_csv(filename).read()
                     metadata = {'variables': list(data.columns.values),
                                 'geospatial_lon_min': float(data['longitude'].min()),
                                 'geospatial_lat_min': float(data['latitude'].min()),
                                 'geospatial_lon_max': float(data['longitude'].max()),
                                 'geospatial_lat_max': float(data['latitude'].max()),
-                                'time_coverage_start': data['time'].min(),
-                                'time_coverage_end': data['time'].max()}
-                    file_intake.metadata = metadata
+                                'time_coverage_start': str(data['time'].min()),
+                                'time_coverage_end': str(data['time'].max())}
 #                                             'time variables info': 'test', 'space variables info': 'test'}
                 elif 'nc' in filename:
-                    file_intake = intake.open_netcdf(filename)
-                    data = file_intake.read()
+                    driver = 'netcdf'
+                    data = intake.open_netcdf(filename).read()
                     metadata = {'coords': list(data.coords.keys()),
                                 'variables': list(data.data_vars.keys()),
                                 }
-                    file_intake.metadata = metadata
-
-                file_intake.name = filename.split('/')[-1]
-                lines += file_intake.yaml().strip('sources:')
 
-            f = open(self.catalog_name, "w")
-            f.write(lines)
-            f.close()    
+                sources[filename.split('/')[-1]] = {'description': '', 'driver': driver, 
+                                                    'args': {'urlpath': filename}, 
+                                                    'metadata': metadata}
+            
+            self._sources = sources
+        
+        return self._sources
+    
+    
+    def write_catalog(self, path=None):
+        '''Write the catalog to `path`, or `catalog_name`, as YAML.'''
+        
+        export_catalog(self.sources, path or self.catalog_name)
 
     
     @property
     def catalog(self):
+        '''Intake catalog of the files, built in memory or reused.'''
         
         if not hasattr(self, '_catalog'):
             
-            self.write_catalog()
-            catalog = intake.open_catalog(self.catalog_name)
+            if (self.catalog_name is not None) and os.path.exists(self.catalog_name):
+                catalog = intake.open_catalog(self.catalog_name)
+            elif (self.catalog_name is None) and self.catalog_store.has(self.cache_key):
+                catalog = intake.open_catalog(self.catalog_store.path(self.cache_key))
+            else:
+                catalog = make_catalog(self.sources, name=self.name)
+                if self.catalog_name is not None:
+                    self.write_catalog()
+                else:
+                    self.catalog_store.set(self.cache_key, self.sources)
             self._catalog = catalog
             
         return self._catalog
@@ -176,8 +208,7 @@ class localReader:
         if not hasattr(self, '_data'):
             
             if self.parallel:
-                num_cores = multiprocessing.cpu_count()
-                downloads = Parallel(n_jobs=num_cores)(
+                downloads = Parallel(n_jobs=self.n_jobs, prefer='threads')(
                     delayed(self.data_by_dataset)(dataset_id) for dataset_id in self.dataset_ids
                 )
             else:
@@ -202,7 +233,9 @@ class region(localReader):
     def __init__(self, kwargs):
         lo_kwargs = {'catalog_name': kwargs.get('catalog_name', None),
                      'filenames': kwargs.get('filenames', None),
-                     'parallel': kwargs.get('parallel', True)}
+                     'parallel': kwargs.get('parallel', True),
+                     'n_jobs': kwargs.get('n_jobs', None),
+                     'catalog_ttl': kwargs.get('catalog_ttl', '1D')}
         localReader.__init__(self, **lo_kwargs)
         
         kw = kwargs['kw']
@@ -221,10 +254,8 @@ class region(localReader):
         if (variables is not None) and (not isinstance(variables, list)):
             variables = [variables]
             
-        # make sure variables are on parameter list
-        if variables is not None:
-            self.check_variables(variables)            
-            
+        # there is no parameter list for local files to check 
+        # variables against
         self.variables = variables
 #         # DOESN'T CURRENTLY LIMIT WHICH VARIABLES WILL BE FOUND ON EACH SERVER
         
@@ -240,7 +271,9 @@ class stations(localReader):
     def __init__(self, kwargs):
         loc_kwargs = {'catalog_name': kwargs.get('catalog_name', None),
                      'filenames': kwargs.get('filenames', None),
-                     'parallel': kwargs.get('parallel', True)}
+                     'parallel': kwargs.get('parallel', True),
+                     'n_jobs': kwargs.get('n_jobs', None),
+                     'catalog_ttl': kwargs.get('catalog_ttl', '1D')}
         localReader.__init__(self, **loc_kwargs)
         
         kw = kwargs.get('kw', None)
@@ -1,5 +1,8 @@
 from search.axdsReader import axdsReader
+from search.transport import transport
+from search.variables import reset_indexes
 import pandas as pd
+import threading
 import numpy as np
 from datetime import datetime
 import xarray as xr
@@ -94,6 +97,24 @@ def test_station_layer_group_2dataset_ids():
 def test_variables():
     pass
 
+def test_search_variables_without_store(tmp_path, monkeypatch):
+    # the store is in ../cache/variables
+    (tmp_path / 'run').mkdir()
+    monkeypatch.chdir(tmp_path / 'run')
+    tags = {'tags': {'Parameter Group': [{'label': 'Salinity', 'count': 70}, 
+                                         {'label': 'Water Temperature', 'count': 30}]}}
+    monkeypatch.setattr(transport, 'get', lambda url, **kwargs: tags)
+    reset_indexes()
+    
+    results = []
+    reader = axdsReader(axds_type='platform2')
+    thread = threading.Thread(target=lambda: results.append(reader.search_variables('sal')), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), 'search_variables hung'
+    assert list(results[0].index) == ['Salinity']
+    reset_indexes()
+
 
 ## Test Platforms, region ##
 
@@ -0,0 +1,83 @@
+from search.cache import QueryCache, StationMap, OpendapUrls, DataCache, hash_query
+import pandas as pd
+import xarray as xr
+import os
+import time
+
+
+def test_hash_query_order():
+    assert hash_query(a=1, kw={'x': 1, 'y': 2}) == hash_query(kw={'y': 2, 'x': 1}, a=1)
+    assert hash_query(a=1) != hash_query(a=2)
+
+def test_query_cache_disabled(tmp_path):
+    cache = QueryCache(ttl=None, cache_dir=str(tmp_path))
+    cache.set('key', 'meta', pd.DataFrame())
+    assert not cache.has('key', 'meta')
+    assert os.listdir(tmp_path) == []
+
+def test_query_cache_roundtrip(tmp_path):
+    cache = QueryCache(ttl='1D', cache_dir=str(tmp_path))
+    key = hash_query(reader='ErddapReader', kw={'min_time': '2019-1-1'})
+    meta = pd.DataFrame(index=['tabs_b'], data={'download_url': ['url']})
+    cache.set(key, 'meta', meta)
+    cache.set(key, 'dataset_ids', ['tabs_b'])
+    assert cache.has(key, 'meta')
+    assert cache.get(key, 'meta').equals(meta)
+    assert cache.get(key, 'dataset_ids') == ['tabs_b']
+    cache.invalidate(key)
+    assert not cache.has(key, 'meta')
+    assert not cache.has(key, 'dataset_ids')
+
+def test_query_cache_ttl(tmp_path):
+    cache = QueryCache(ttl=1, cache_dir=str(tmp_path))
+    cache.set('key', 'dataset_ids', ['tabs_b'])
+    assert cache.has('key', 'dataset_ids')
+    old = time.time() - 10
+    os.utime(cache.path('key', 'dataset_ids'), (old, old))
+    assert not cache.has('key', 'dataset_ids')
+
+def test_station_map(tmp_path):
+    station_map = StationMap('erddap_test', cache_dir=str(tmp_path))
+    assert station_map.get(['tabs_b']) == {}
+    station_map.update({'tabs_b': 'tabs_b', '8771013': 'noaa_nos_co_ops_8771013'})
+    # another reader for the same server
+    station_map = StationMap('erddap_test', cache_dir=str(tmp_path))
+    assert station_map.get(['8771013', 'tabs_d']) == {'8771013': 'noaa_nos_co_ops_8771013'}
+    station_map.invalidate(['8771013'])
+    assert station_map.load() == {'tabs_b': 'tabs_b'}
+
+def test_data_cache_table(tmp_path):
+    cache = DataCache('erddap_test', cache_dir=str(tmp_path))
+    key = hash_query(dataset_id='tabs_b')
+    assert cache.read(key) is None and cache.coverage(key) == []
+    index = pd.date_range('2019-1-31', periods=48, freq='h', tz='UTC', name='time (UTC)')
+    data = pd.DataFrame(index=index, data={'x (m)': range(48)})
+    cache.write(key, data[:30])
+    # overlapping rows are only stored once
+    cache.write(key, data[24:])
+    cache.add_coverage(key, [(index[0], index[29])])
+    cache.add_coverage(key, [(index[24], index[-1])])
+    assert sorted(os.listdir(tmp_path / 'erddap_test' / key[:16])) == ['2019-01.parquet', '2019-02.parquet', 'state.json']
+    assert cache.read(key).equals(data)
+    assert cache.read(key, index[10], index[20]).equals(data[10:21])
+    assert cache.coverage(key) == [(index[0], index[-1])]
+    assert cache.last_time(key) == index[-1]
+    cache.invalidate(key)
+    assert cache.read(key) is None
+
+def test_data_cache_grid(tmp_path):
+    cache = DataCache('erddap_test', cache_dir=str(tmp_path))
+    key = hash_query(dataset_id='hfradar')
+    times = pd.date_range('2019-1-1', periods=10, freq='h')
+    ds = xr.Dataset({'u': (('time', 'latitude'), [[i, i] for i in range(10)])}, 
+                    coords={'time': times, 'latitude': [28., 29.]})
+    cache.write(key, ds.isel(time=slice(0, 6)))
+    cache.write(key, ds.isel(time=slice(4, 10)))
+    assert cache.read(key).identical(ds)
+    assert cache.read(key, times[2], times[3]).identical(ds.isel(time=slice(2, 4)))
+
+def test_opendap_urls(tmp_path):
+    url_store = OpendapUrls('axds_layer_group', cache_dir=str(tmp_path))
+    url_store.update({'lg1': 'http://thredds/dodsC/model.nc', 'lg2': ''})
+    url_store = OpendapUrls('axds_layer_group', cache_dir=str(tmp_path))
+    assert url_store.get(['lg1', 'lg2', 'lg3']) == {'lg1': 'http://thredds/dodsC/model.nc', 'lg2': ''}
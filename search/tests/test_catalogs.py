@@ -0,0 +1,58 @@
+from search.catalogs import make_catalog, export_catalog, CatalogStore
+from search.cache import hash_query
+import intake
+import pandas as pd
+import os
+import time
+
+
+def test_catalog_export_roundtrip(tmp_path):
+    filename = str(tmp_path / 'station.csv')
+    pd.DataFrame({'time': ['2019-01-01T00:00:00Z'], 'temp': [20.]}).to_csv(filename, index=False)
+    sources = {'station': {'description': 'a station', 'driver': 'csv', 
+                           'args': {'urlpath': filename},
+                           'metadata': {'variables': ['temp'], 'geospatial_lon_min': -95.}}}
+    catalog = make_catalog(sources, name='test')
+    assert list(catalog) == ['station']
+    assert catalog['station'].metadata['variables'] == ['temp']
+    export_catalog(sources, str(tmp_path / 'catalog.yml'))
+    catalog = intake.open_catalog(str(tmp_path / 'catalog.yml'))
+    assert catalog['station'].description == 'a station'
+    assert catalog['station'].metadata['geospatial_lon_min'] == -95.
+    assert catalog['station'].read()['temp'].tolist() == [20.]
+
+def test_catalog_store(tmp_path):
+    store = CatalogStore(max_age='1D', max_size=1000, cache_dir=str(tmp_path))
+    sources = {'station': {'driver': 'csv', 'args': {'urlpath': 'station.csv'}}}
+    key = hash_query(reader='axdsReader', kw={'min_time': '2019-1-1'})
+    assert not store.has(key)
+    store.set(key, sources)
+    assert store.has(key)
+    assert list(intake.open_catalog(store.path(key))) == ['station']
+    # old catalogs are evicted when a new one is written
+    old = time.time() - 2*86400
+    os.utime(store.path(key), (old, old))
+    assert not store.has(key)
+    store.set(hash_query(reader='axdsReader'), sources)
+    assert not os.path.exists(store.path(key))
+    store.invalidate(hash_query(reader='axdsReader'))
+    assert os.listdir(tmp_path) == []
+
+
+def test_catalog_store_evicts_only_its_own_expired_catalogs(tmp_path):
+    sources = {'station': {'driver': 'csv', 'args': {'urlpath': 'station.csv'}}}
+    long_store = CatalogStore(max_age='7D', cache_dir=str(tmp_path))
+    short_store = CatalogStore(max_age='1D', cache_dir=str(tmp_path))
+    key = hash_query(reader='axdsReader', kw={'min_time': '2019-1-1'})
+    long_store.set(key, sources)
+    # a catalog_name that happens to be in the same directory
+    user_catalog = os.path.join(tmp_path, 'catalog_mine.yml')
+    export_catalog(sources, user_catalog)
+    old = time.time() - 2*86400
+    for path in [long_store.path(key), user_catalog]:
+        os.utime(path, (old, old))
+    short_store.set(hash_query(reader='axdsReader'), sources)
+    # still within the max_age it was written with
+    assert os.path.exists(long_store.path(key))
+    assert long_store.has(key) and not short_store.has(key)
+    assert os.path.exists(user_catalog)
@@ -0,0 +1,159 @@
+from search.transport import Transport, HTTPCache, HostPolicy, CircuitOpenError
+from aiohttp import web
+import aiohttp
+import asyncio
+import pytest
+import os
+import time
+
+
+def serve(transport, handler):
+    '''Start a local server on the transport's loop and return its url.'''
+
+    async def start():
+        app = web.Application()
+        app.router.add_get('/{name}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+
+    runner, port = transport.run(start())
+    return runner, f'http://127.0.0.1:{port}'
+
+def test_http_cache_revalidates(tmp_path):
+    requests = []
+
+    async def handler(request):
+        requests.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.json_response({'name': request.match_info['name']}, headers={'ETag': '"v1"'})
+
+    transport = Transport(http_cache=HTTPCache(cache_dir=str(tmp_path)))
+    runner, url = serve(transport, handler)
+    try:
+        assert transport.get(f'{url}/a', response='json', cache=True) == {'name': 'a'}
+        # served from the local copy after a 304
+        assert transport.get(f'{url}/a', response='json', cache=True) == {'name': 'a'}
+        assert requests == [None, '"v1"']
+        # without cache the response isn't stored or revalidated
+        assert transport.get(f'{url}/a', response='json') == {'name': 'a'}
+        assert requests[-1] is None
+    finally:
+        transport.close()
+        transport.run(runner.cleanup())
+
+def test_http_cache_evicts_least_recently_used(tmp_path):
+    cache = HTTPCache(cache_dir=str(tmp_path), max_size=25)
+    for i, key in enumerate(['a', 'b']):
+        cache.set(key, b'x'*10, {'etag': key})
+        old = time.time() - 100 + i
+        os.utime(cache.path(key, 'body'), (old, old))
+    cache.touch('a')
+    cache.set('c', b'x'*10, {'etag': 'c'})
+    assert cache.get('b') == (None, {})
+    assert cache.get('a')[0] == b'x'*10
+    assert cache.get('c')[1] == {'etag': 'c'}
+
+def test_http_cache_reads_index_once(tmp_path):
+    cache = HTTPCache(cache_dir=str(tmp_path), max_size=25)
+    for i, key in enumerate(['a', 'b']):
+        cache.set(key, b'x'*10, {'etag': key})
+        old = time.time() - 100 + i
+        os.utime(cache.path(key, 'body'), (old, old))
+    # a new cache on the same directory orders stored responses by use
+    cache = HTTPCache(cache_dir=str(tmp_path), max_size=25)
+    assert list(cache.index) == ['a', 'b']
+    cache.set('c', b'x'*10, {'etag': 'c'})
+    assert list(cache.index) == ['b', 'c']
+    assert cache._size == 20
+    assert not os.path.exists(cache.path('a', 'body'))
+
+def test_retries_transient_failures():
+    requests = []
+
+    async def handler(request):
+        name = request.match_info['name']
+        requests.append(name)
+        if name == 'missing':
+            return web.Response(status=404)
+        if (name == 'flaky') and (requests.count(name) < 3):
+            return web.Response(status=503)
+        return web.Response(text=name)
+
+    policy = HostPolicy(retries=3, backoff=0.01, failure_threshold=10)
+    transport = Transport(default_policy=policy)
+    runner, url = serve(transport, handler)
+    try:
+        assert transport.get(f'{url}/flaky') == 'flaky'
+        assert requests.count('flaky') == 3
+        # a 404 is an answer so it isn't tried again
+        with pytest.raises(aiohttp.ClientResponseError):
+            transport.get(f'{url}/missing')
+        assert requests.count('missing') == 1
+        assert len(transport.failures) == 0
+    finally:
+        transport.close()
+        transport.run(runner.cleanup())
+
+def test_circuit_opens_for_failing_host():
+    requests = []
+
+    async def handler(request):
+        requests.append(request.match_info['name'])
+        return web.Response(status=500)
+
+    policy = HostPolicy(retries=1, backoff=0.01, failure_threshold=2, reset_after=60)
+    transport = Transport(default_policy=policy)
+    runner, url = serve(transport, handler)
+    try:
+        with pytest.raises(aiohttp.ClientResponseError):
+            transport.get(f'{url}/a')
+        # the host isn't requested again while the circuit is open
+        responses = transport.get_many([f'{url}/b', f'{url}/c'])
+        assert all(isinstance(response, CircuitOpenError) for response in responses)
+        assert requests == ['a', 'a']
+        assert [failure['url'] for failure in transport.failures] == [f'{url}/a', f'{url}/b', f'{url}/c']
+    finally:
+        transport.close()
+        transport.run(runner.cleanup())
+
+def test_same_url_requested_once_in_flight():
+    requests = []
+
+    async def handler(request):
+        requests.append(request.match_info['name'])
+        await asyncio.sleep(0.1)
+        return web.json_response([{'uuid': request.match_info['name']}])
+
+    transport = Transport()
+    runner, url = serve(transport, handler)
+    try:
+        responses = transport.get_many([f'{url}/a', f'{url}/b', f'{url}/a'], response='json')
+        assert responses == [[{'uuid': 'a'}], [{'uuid': 'b'}], [{'uuid': 'a'}]]
+        assert sorted(requests) == ['a', 'b']
+        # finished requests are made again
+        transport.get(f'{url}/a', response='json')
+        assert requests.count('a') == 2
+    finally:
+        transport.close()
+        transport.run(runner.cleanup())
+
+def test_get_many_if_changed():
+
+    async def handler(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text=request.match_info['name'], headers={'ETag': '"v1"'})
+
+    transport = Transport()
+    runner, url = serve(transport, handler)
+    try:
+        responses = transport.get_many_if_changed([f'{url}/a', f'{url}/b'], 
+                                                  [{'etag': '"v1"'}, {}], response='text')
+        assert responses == [(None, {'etag': '"v1"'}), ('b', {'etag': '"v1"', 'last_modified': None})]
+    finally:
+        transport.close()
+        transport.run(runner.cleanup())
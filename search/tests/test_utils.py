@@ -0,0 +1,204 @@
+from search.utils import (parse_info, parse_infos, parse_chunk_size, time_windows,
+                          spatial_constraints, clip_to_box, frame_from_nc, frame_from_parquet,
+                          griddap_query, count_rows, merge_intervals, missing_intervals,
+                          griddap_time_url, read_csv_window, time_key, time_indexer, utc_end)
+import io
+import pytest
+import numpy as np
+import xarray as xr
+import pandas as pd
+
+
+def make_info(rows):
+    return pd.DataFrame([['attribute', 'NC_GLOBAL'] + row for row in rows], 
+                        columns=['Row Type', 'Variable Name', 'Attribute Name', 'Data Type', 'Value'])
+
+COLUMNS = ['geospatial_lat_min', 'time_coverage_start', 'featureType', 'id', 'source']
+
+INFO = make_info([['geospatial_lat_min', 'double', '27.5'],
+                  ['time_coverage_start', 'String', '2019-01-01T00:00:00Z'],
+                  ['id', 'String', 'tabs_b'],
+                  ['geospatial_lat_min', 'double', '99']])
+
+
+def test_parse_info():
+    assert parse_info(INFO, COLUMNS) == [27.5, '2019-01-01T00:00:00Z', 'grid', 'tabs_b', 'NA']
+
+def test_parse_infos_matches_parse_info():
+    info2 = make_info([['featureType', 'String', 'TimeSeries'], ['source', 'int', '3']])
+    meta = parse_infos({'tabs_b': INFO, 'other': info2}, COLUMNS)
+    assert list(meta.index) == ['tabs_b', 'other']
+    assert list(meta.columns) == COLUMNS
+    assert list(meta.loc['tabs_b']) == parse_info(INFO, COLUMNS)
+    assert list(meta.loc['other']) == parse_info(info2, COLUMNS)
+    assert meta.loc['other', 'source'] == 3
+
+def test_parse_infos_empty():
+    meta = parse_infos({}, COLUMNS)
+    assert meta.empty
+    assert list(meta.columns) == COLUMNS
+
+def test_parse_chunk_size():
+    assert parse_chunk_size(100000) == ('rows', 100000)
+    assert parse_chunk_size('20MB') == ('bytes', 20e6)
+    assert parse_chunk_size('30D') == ('time', pd.Timedelta('30D'))
+
+def test_time_windows():
+    windows = time_windows('2021-1-1', '2021-1-8', '3D')
+    assert windows == [(pd.Timestamp('2021-1-1'), pd.Timestamp('2021-1-4')),
+                       (pd.Timestamp('2021-1-4'), pd.Timestamp('2021-1-7')),
+                       (pd.Timestamp('2021-1-7'), pd.Timestamp('2021-1-8'))]
+    assert time_windows('2021-1-1', '2021-1-1', '3D') == [(pd.Timestamp('2021-1-1'), pd.Timestamp('2021-1-1'))]
+
+
+def test_spatial_constraints():
+    kw = {'min_lon': -99, 'max_lon': -88, 'min_lat': 20, 'max_lat': 30}
+    constraints = spatial_constraints(kw, lon_range=(-180, 180))
+    assert constraints == {'latitude>=': 20, 'latitude<=': 30, 
+                           'longitude>=': -99, 'longitude<=': -88}
+    # dataset in 0 to 360 longitudes
+    constraints = spatial_constraints(kw, lon_range=(0, 360))
+    assert constraints['longitude>='] == 261 and constraints['longitude<='] == 272
+    # box crossing the seam is clipped locally instead
+    constraints = spatial_constraints({'min_lon': -10, 'max_lon': 10}, lon_range=(0, 360))
+    assert 'longitude>=' not in constraints
+
+def test_clip_to_box():
+    kw = {'min_lon': -99, 'max_lon': -88, 'min_lat': 20, 'max_lat': 30}
+    df = pd.DataFrame({'longitude (degrees_east)': [-95, 265, -80, np.nan],
+                       'latitude (degrees_north)': [25, 25, 25, 25]})
+    assert list(clip_to_box(df, kw).index) == [0, 1, 3]
+
+def test_frame_from_parquet():
+    times = pd.date_range('2019-1-1', periods=3, freq='h')
+    content = pd.DataFrame({'time': (times - pd.Timestamp('1970-01-01'))//pd.Timedelta('1s'), 'station': ['a']*3,
+                            'sea_water_temperature': [1., 2., 3.]}).to_parquet()
+    units = {'time': 'seconds since 1970-01-01T00:00:00Z', 'sea_water_temperature': 'degree_C'}
+    df = frame_from_parquet(content, units)
+    assert df.index.name == 'time (UTC)'
+    assert (df.index == times.tz_localize('UTC')).all()
+    assert list(df.columns) == ['station', 'sea_water_temperature (degree_C)']
+
+def test_frame_from_nc():
+    times = pd.date_range('2019-1-1', periods=3, freq='h')
+    ds = xr.Dataset({'time': ('row', times), 'sea_water_temperature': ('row', [1., 2., 3.])})
+    ds['sea_water_temperature'].attrs['units'] = 'degree_C'
+    content = ds.to_netcdf(format='NETCDF3_CLASSIC', engine='scipy')
+    df = frame_from_nc(bytes(content))
+    assert df.index.name == 'time (UTC)'
+    assert (df.index == times.tz_localize('UTC')).all()
+    assert list(df.columns) == ['sea_water_temperature (degree_C)']
+
+def test_griddap_query():
+    info = pd.DataFrame([['dimension', 'time', '', 'double', ''],
+                         ['attribute', 'time', 'actual_range', 'double', '1.5463008E9, 1.6094592E9'],
+                         ['dimension', 'latitude', '', 'double', ''],
+                         ['attribute', 'latitude', 'actual_range', 'double', '20.0, 50.0'],
+                         ['dimension', 'longitude', '', 'double', ''],
+                         ['attribute', 'longitude', 'actual_range', 'double', '0.0, 359.9'],
+                         ['variable', 'u', '', 'float', ''],
+                         ['variable', 'v', '', 'float', '']], 
+                        columns=['Row Type', 'Variable Name', 'Attribute Name', 'Data Type', 'Value'])
+    kw = {'min_lon': -99, 'max_lon': -88, 'min_lat': 10, 'max_lat': 30,
+          'min_time': '2019-1-1', 'max_time': '2022-1-1'}
+    query = griddap_query(info, kw, variables=['u'], stride={'time': 2})
+    assert query == ('u%5B(2019-01-01T00:00:00Z):2:(2021-01-01T00:00:00Z)%5D'
+                     '%5B(20.0):1:(30)%5D%5B(261):1:(272)%5D')
+    # time outside the dataset
+    assert griddap_query(info, dict(kw, max_time='2018-1-1', min_time='2017-1-1')) is None
+
+def test_count_rows():
+    assert count_rows('Title,Summary,Dataset ID\na,"two\nlines",x\nb,one,y\n') == 2
+    assert count_rows('Title,Summary,Dataset ID\n') == 0
+
+def test_missing_intervals():
+    assert merge_intervals([(5, 8), (1, 3), (2, 4)]) == [(1, 4), (5, 8)]
+    assert missing_intervals([], 1, 10) == [(1, 10)]
+    assert missing_intervals([(1, 10)], 5, 20) == [(10, 20)]
+    assert missing_intervals([(5, 10)], 1, 20) == [(1, 5), (10, 20)]
+    assert missing_intervals([(1, 3), (5, 10)], 2, 8) == [(3, 5)]
+    assert missing_intervals([(1, 10)], 2, 8) == []
+
+def test_griddap_time_url():
+    url = ('https://server/erddap/griddap/hfradar.nc?u%5B(2019-01-01T00:00:00Z):2:(2019-02-01T00:00:00Z)%5D'
+           '%5B(20.0):1:(30)%5D,v%5B(2019-01-01T00:00:00Z):2:(2019-02-01T00:00:00Z)%5D%5B(20.0):1:(30)%5D')
+    narrowed = griddap_time_url(url, pd.Timestamp('2019-1-15', tz='UTC'), pd.Timestamp('2019-3-1', tz='UTC'))
+    assert narrowed == url.replace('(2019-01-01T00:00:00Z)', '(2019-01-15T00:00:00Z)')
+    assert griddap_time_url(url, '2018-1-1', '2018-2-1') is None
+
+def make_platform_csv(n=1000):
+    times = pd.date_range('2019-1-1', periods=n, freq='h').strftime('%Y-%m-%dT%H:%M:%SZ')
+    return pd.DataFrame({'time': times, 'z': 0., 'temp': np.arange(n)/10, 
+                         'station': 'abc'}).to_csv(index=False).encode()
+
+class Counting(io.BytesIO):
+    '''Remembers how many bytes were read.'''
+    read_bytes = 0
+    def read(self, *args):
+        data = super().read(*args)
+        self.read_bytes += len(data)
+        return data
+    def read1(self, *args):
+        return self.read(*args)
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+@pytest.mark.parametrize('engine', ['pyarrow', 'pandas'])
+def test_read_csv_window(engine):
+    content = make_platform_csv(100000)
+    f = Counting(content)
+    df = read_csv_window(f, '2019-1-2', '2019-1-3', columns=['temp'], block_size=10000, engine=engine)
+    assert list(df.columns) == ['temp'] and df.index.name == 'time'
+    assert df.index[0] == pd.Timestamp('2019-1-2', tz='UTC')
+    # all of the last day, like slicing by label
+    assert df.index[-1] == pd.Timestamp('2019-1-3T23:00', tz='UTC')
+    assert df['temp'].tolist() == [i/10 for i in range(24, 72)]
+    # stopped reading after the window
+    assert f.read_bytes < len(content)/2
+    assert len(read_csv_window(io.BytesIO(content), end='2018-1-1', engine=engine)) == 0
+
+def test_utc_end():
+    assert utc_end('2020-8-2') == pd.Timestamp('2020-8-2T23:59:59.999999', tz='UTC')
+    assert utc_end('2020-8') == pd.Timestamp('2020-8-31T23:59:59.999999', tz='UTC')
+    assert utc_end('2020-8-2T12:00+02:00') == pd.Timestamp('2020-8-2T10:00:59.999999', tz='UTC')
+    assert utc_end(pd.Timestamp('2020-8-2')) == pd.Timestamp('2020-8-2', tz='UTC')
+
+def test_read_csv_window_unsorted():
+    content = make_platform_csv(100)
+    lines = content.decode().splitlines()
+    # out of order at the start, so an early time at the end is read
+    content = '\n'.join(lines[:1] + lines[60:61] + lines[1:] + lines[6:7]).encode()
+    df = read_csv_window(io.BytesIO(content), '2019-1-1T05:00', '2019-1-1T06:00', block_size=500)
+    assert len(df) == 3
+
+def test_read_csv_window_changing_types():
+    # a column that looks like ints at first is read again with pandas
+    content = b'time,flag\n' + b''.join(f'2019-01-01T{i % 24:02d}:00:00Z,{i}\n'.encode() for i in range(200))
+    content += b'2019-01-02T00:00:00Z,1.5\n'
+    df = read_csv_window(io.BytesIO(content), block_size=500)
+    assert len(df) == 201 and df['flag'].iloc[-1] == 1.5
+
+def test_time_key():
+    ds = xr.Dataset(coords={'ocean_time': [0, 1], 'time_bounds': [0, 1]})
+    assert time_key(ds) == 'ocean_time'
+    ds['time_bounds'].attrs['standard_name'] = 'time'
+    assert time_key(ds) == 'time_bounds'
+
+def test_time_indexer():
+    times = pd.date_range('2019-1-1', periods=48, freq='h').to_numpy()
+    assert time_indexer(times, '2019-1-1T10:00', '2019-1-1T12:00') == slice(10, 13)
+    assert time_indexer(times, '2019-1-1T10:00Z', '2019-1-1T12:00Z') == slice(10, 13)
+    assert time_indexer(times, '2018-1-1', '2018-2-1') == slice(0, 0)
+    # all of the last day
+    assert time_indexer(times, '2019-1-1', '2019-1-1') == slice(0, 24)
+    # repeated times are only looked for in the window
+    repeated = np.repeat(times, 2)
+    assert list(time_indexer(repeated, '2019-1-1T10:00', '2019-1-1T12:00')) == [20, 22, 24]
+    # a model restart goes back in time
+    restarted = np.concatenate([times[:24], times[20:]])
+    assert time_indexer(restarted, '2019-1-1T19:00', '2019-1-1T21:00') == slice(19, 22)
+    assert time_indexer(restarted, '2019-1-2', '2019-1-2T02:00') == slice(28, 31)
+    shuffled = times[::-1]
+    assert list(shuffled[time_indexer(shuffled, '2019-1-1T10:00', '2019-1-1T12:00')]) == list(times[10:13])
@@ -0,0 +1,98 @@
+from search.variables import VariableStore, VariableIndex, get_index, reset_indexes
+import pandas as pd
+import threading
+import time
+
+
+def test_variable_store_roundtrip(tmp_path):
+    store = VariableStore('erddap_test', cache_dir=str(tmp_path))
+    assert store.load() is None and store.refreshed is None
+    variables = pd.DataFrame(index=pd.Index(['salinity', 'temp'], name='variable'),
+                             data={'count': [2, 1], 'refreshed': [100., 200.]})
+    store.save(variables)
+    loaded = store.load()
+    assert loaded.equals(variables)
+    # kept in memory until the store changes
+    assert store.load() is loaded
+    assert list(store.stale(loaded, 50, 200)) == [True, False]
+
+
+def test_variable_store_validators(tmp_path):
+    store = VariableStore('erddap_test', cache_dir=str(tmp_path))
+    variables = pd.DataFrame(index=pd.Index(['salinity', 'temp'], name='variable'),
+                             data={'count': [2, 1], 'refreshed': [100., 200.], 
+                                   'etag': ['"s1"', None], 'last_modified': [None, None]})
+    store.save(variables)
+    assert store.validators(store.load()) == [{'etag': '"s1"', 'last_modified': None}, 
+                                              {'etag': None, 'last_modified': None}]
+
+
+def make_index():
+    ioos = pd.DataFrame(index=pd.Index(['sea_water_temperature', 'sea_water_practical_salinity', 
+                                        'wind_speed'], name='variable'),
+                        data={'count': [100, 50, 20]})
+    axds = pd.DataFrame(index=pd.Index(['Salinity', 'Water Temperature'], name='variable'),
+                        data={'count': [70, 30]})
+    return VariableIndex({'erddap_ioos': ioos, 'axds_platform2': axds})
+
+def test_variable_index_search():
+    index = make_index()
+    results = index.search('salinity')
+    assert list(results.index) == ['Salinity', 'sea_water_practical_salinity']
+    assert list(results.columns) == ['count', 'erddap_ioos', 'axds_platform2']
+    assert list(index.search(['wind', 'SALINITY'])['count']) == [70, 50, 20]
+    # still takes regular expressions
+    assert list(index.search('sea.*temp').index) == ['sea_water_temperature']
+    # typo
+    assert len(index.search('salinty')) == 0
+    assert 'Salinity' in index.search('salinty', fuzzy=True).index
+
+def test_variable_index_complete():
+    index = make_index()
+    assert index.complete('wat') == ['Water Temperature', 'sea_water_temperature', 
+                                     'sea_water_practical_salinity']
+    assert index.complete('wat', limit=1) == ['Water Temperature']
+
+def test_variable_store_lock(tmp_path):
+    store = VariableStore('axds_test', cache_dir=str(tmp_path))
+    events = []
+
+    def refresh(name):
+        with store.lock():
+            events.append(f'{name} start')
+            time.sleep(0.05)
+            events.append(f'{name} end')
+
+    threads = [threading.Thread(target=refresh, args=(name,)) for name in 'ab']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # one refresh at a time
+    assert events[0].split()[0] == events[1].split()[0]
+    assert events[2].split()[0] == events[3].split()[0]
+
+
+def test_get_index_with_empty_store(tmp_path):
+    store = VariableStore('erddap_test', cache_dir=str(tmp_path))
+
+    def counts():
+        # like all_variables the first time, which refreshes the store 
+        # and then resets the indexes
+        assert store.load() is None
+        variables = pd.DataFrame(index=pd.Index(['salinity'], name='variable'),
+                                 data={'count': [2], 'refreshed': [time.time()]})
+        store.save(variables)
+        reset_indexes()
+        return {'erddap_test': store.load()}
+
+    reset_indexes()
+    results = []
+    thread = threading.Thread(target=lambda: results.append(get_index('test', counts)), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), 'building the index hung'
+    assert list(results[0].search('sal').index) == ['salinity']
+    # built once
+    assert get_index('test', counts) is results[0]
+    reset_indexes()
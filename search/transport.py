@@ -0,0 +1,627 @@
+'''Asynchronous HTTP transport shared by the readers.
+
+All requests go through one `aiohttp.ClientSession` that keeps pooled,
+keep-alive connections per host. The session lives on an event loop
+running in a background thread so that the blocking reader code (and
+notebooks, which already run their own event loop) can use it with
+`transport.get(url)` or, for many urls at once, `transport.get_many(urls)`.
+
+Requests to each host follow a `HostPolicy`: only so many are in flight
+at once, they are spaced out to a rate, transient failures are retried
+with exponential backoff, and a host that keeps failing is not requested
+for a while.
+'''
+
+import asyncio
+import threading
+import logging
+import os
+import io
+import json
+import time
+import random
+import hashlib
+import urllib.parse
+from collections import deque, OrderedDict
+import aiohttp
+import pandas as pd
+from search.cache import write_atomic
+
+
+# Capture warnings in log
+logging.captureWarnings(True)
+
+# formatting for logfile
+os.makedirs("../logs", exist_ok=True)  # succeeds even if directory exists.
+formatter = logging.Formatter('%(asctime)s %(message)s','%a %b %d %H:%M:%S %Z %Y')
+log_name = 'transport'
+logfilename = os.path.join('..','logs', log_name + '.log')
+loglevel=logging.WARNING
+
+# set up logger file
+handler = logging.FileHandler(logfilename)
+handler.setFormatter(formatter)
+logger_transport = logging.getLogger(log_name)
+logger_transport.setLevel(loglevel)
+logger_transport.addHandler(handler)
+
+
+class HTTPCache:
+    '''Responses stored on disk to revalidate instead of requesting again.
+
+    A response is stored with its ETag and Last-Modified headers, which 
+    are sent back with `If-None-Match` and `If-Modified-Since` the next 
+    time the url is requested. If the server answers 304 Not Modified, 
+    the stored body is used. When the stored responses are larger than 
+    `max_size`, the least recently used are removed.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory to store responses in.
+    max_size: int
+        Number of bytes of responses to keep.
+    '''
+
+    def __init__(self, cache_dir=os.path.join('..', 'cache', 'http'), max_size=200e6):
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._index = None
+        self._size = 0
+
+
+    def key(self, url, headers=None):
+        '''Responses are different for different Accept headers.'''
+
+        accept = (headers or {}).get('Accept', '')
+        return hashlib.sha256(f'{url} {accept}'.encode()).hexdigest()
+
+
+    def path(self, key, suffix):
+        return os.path.join(self.cache_dir, f'{key}.{suffix}')
+
+
+    @property
+    def index(self):
+        '''Size of each stored response by key, least recently used first.
+
+        Read from the directory once, then kept up to date in memory so 
+        storing a response doesn't list the whole directory.
+        '''
+
+        if self._index is None:
+            entries = []
+            if os.path.exists(self.cache_dir):
+                for fname in os.listdir(self.cache_dir):
+                    if fname.endswith('.body'):
+                        try:
+                            stat = os.stat(os.path.join(self.cache_dir, fname))
+                        except OSError:
+                            continue
+                        entries.append((stat.st_mtime, fname[:-len('.body')], stat.st_size))
+            self._index = OrderedDict((key, size) for mtime, key, size in sorted(entries))
+            self._size = sum(self._index.values())
+
+        return self._index
+
+
+    def get(self, key):
+        '''Stored (body, info) for `key`, or (None, {}).
+
+        `info` has the validators and encoding of the response.
+        '''
+
+        try:
+            with open(self.path(key, 'json')) as f:
+                info = json.load(f)
+            with open(self.path(key, 'body'), 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, {}
+
+        return body, info
+
+
+    def touch(self, key):
+        '''Mark `key` as recently used.'''
+
+        try:
+            os.utime(self.path(key, 'body'))
+        except OSError:
+            pass
+
+        with self._lock:
+            if key in self.index:
+                self.index.move_to_end(key)
+
+
+    def set(self, key, body, info):
+
+        # read the directory before this response is in it
+        with self._lock:
+            self.index
+
+        write_atomic(self.path(key, 'body'), body)
+        write_atomic(self.path(key, 'json'), json.dumps(info), mode='w')
+
+        with self._lock:
+            self._size += len(body) - self.index.pop(key, 0)
+            self.index[key] = len(body)
+            if self._size > self.max_size:
+                self.evict()
+
+
+    def evict(self):
+        '''Remove least recently used responses until under `max_size`.
+
+        Called with the lock held.
+        '''
+
+        while (self._size > self.max_size) and self.index:
+            key, size = self.index.popitem(last=False)
+            for suffix in ['body', 'json']:
+                try:
+                    os.remove(self.path(key, suffix))
+                except OSError:
+                    pass
+            self._size -= size
+
+
+    def clear(self):
+
+        with self._lock:
+            if os.path.exists(self.cache_dir):
+                for fname in os.listdir(self.cache_dir):
+                    os.remove(os.path.join(self.cache_dir, fname))
+            self._index = None
+            self._size = 0
+
+
+# responses worth trying again
+TRANSIENT_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+def transient(error):
+    '''Whether `error` could go away if the request is tried again.'''
+
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in TRANSIENT_STATUS
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, 
+                              aiohttp.ClientPayloadError))
+
+
+class CircuitOpenError(Exception):
+    '''Requests to a host are not sent because it has been failing.'''
+
+
+class HostPolicy:
+    '''How requests to a single host are made.
+
+    Parameters
+    ----------
+    max_in_flight: int
+        Number of requests to the host at once.
+    rate: float or None
+        Number of requests per second on average. None for no limit.
+    burst: int
+        Number of requests that can be made at once before `rate` applies.
+    timeout: float or None
+        Seconds allowed for one attempt. None uses the transport's timeout.
+    retries: int
+        Number of times to try again after a transient failure, like a 
+        503 response or a dropped connection.
+    backoff: float
+        Seconds to wait before the first retry. This doubles for each 
+        retry up to `max_backoff`, with jitter.
+    max_backoff: float
+        Longest wait between retries.
+    failure_threshold: int
+        Number of transient failures in a row after which requests to 
+        the host fail right away.
+    reset_after: float
+        Seconds after which one request is let through again to check 
+        whether the host is back.
+    '''
+
+    def __init__(self, max_in_flight=10, rate=None, burst=10, timeout=None, retries=3, 
+                 backoff=0.5, max_backoff=30, failure_threshold=5, reset_after=60):
+
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+
+
+class HostState:
+    '''In-flight limit, token bucket, and circuit breaker for one host.
+
+    Only used from the transport's event loop.
+    '''
+
+    def __init__(self, host, policy):
+
+        self.host = host
+        self.policy = policy
+        self.semaphore = asyncio.Semaphore(policy.max_in_flight)
+        self.tokens = policy.burst
+        self.updated = time.monotonic()
+        self.failures = 0
+        self.opened = None
+
+
+    async def wait_for_token(self):
+        '''Wait until a request can be made within the rate.'''
+
+        if self.policy.rate is None:
+            return
+
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.policy.burst, self.tokens + (now - self.updated)*self.policy.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens)/self.policy.rate)
+
+
+    def check(self):
+        '''Raise CircuitOpenError if requests to the host should fail right away.'''
+
+        if self.opened is None:
+            return
+
+        if time.monotonic() - self.opened < self.policy.reset_after:
+            raise CircuitOpenError(f'{self.host} failed {self.failures} times in a row')
+
+        # let this request check the host and hold back the others
+        self.opened = time.monotonic()
+
+
+    def record(self, ok):
+        '''Count a transient failure or reset the count.'''
+
+        if ok:
+            self.failures = 0
+            self.opened = None
+        else:
+            self.failures += 1
+            if self.failures >= self.policy.failure_threshold:
+                self.opened = time.monotonic()
+
+
+def decode(body, response='text', encoding='utf-8'):
+    '''Body of a response as "text", "json", or "bytes".'''
+
+    if response == 'bytes':
+        return body
+    text = body.decode(encoding or 'utf-8')
+    return json.loads(text) if response == 'json' else text
+
+
+class Transport:
+    '''Pooled asynchronous HTTP client usable from blocking code.
+
+    Parameters
+    ----------
+    limit: int
+        Total number of connections open at once.
+    limit_per_host: int
+        Number of connections open at once to a single host.
+    timeout: float
+        Total number of seconds allowed for one request.
+    http_cache: HTTPCache or None
+        Where responses requested with `cache=True` are stored to be 
+        revalidated. None turns this off.
+    policies: dict
+        HostPolicy by host, like "erddap.sensors.ioos.us".
+    default_policy: HostPolicy
+        Policy for hosts not in `policies`.
+    '''
+
+    def __init__(self, limit=400, limit_per_host=100, timeout=600, http_cache=None, 
+                 policies=None, default_policy=None):
+
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.http_cache = http_cache
+        self.policies = policies or {}
+        self.default_policy = default_policy or HostPolicy()
+
+        # requests that failed after all retries, most recent last
+        self.failures = deque(maxlen=1000)
+
+        self._hosts = {}
+        self._in_flight = {}
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def loop(self):
+        '''Event loop running in a background thread, started on first use.'''
+
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever,
+                                          name='search-transport', daemon=True)
+                thread.start()
+                self._loop = loop
+
+        return self._loop
+
+
+    async def session(self):
+        '''Return the shared session, creating it inside the event loop.'''
+
+        if (self._session is None) or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host)
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+        return self._session
+
+
+    def set_policy(self, host, policy):
+        '''Use `policy` for requests to `host` from now on.'''
+
+        self.policies[host] = policy
+        self._hosts.pop(host, None)
+
+
+    def host_state(self, url):
+        '''HostState for the host of `url`.'''
+
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = HostState(host, self.policies.get(host, self.default_policy))
+        return self._hosts[host]
+
+
+    def record_failure(self, url, error, attempts):
+
+        self.failures.append({'time': time.time(), 'url': url, 'error': repr(error), 
+                              'attempts': attempts})
+        logger_transport.warning(f'{url} failed after {attempts} attempts: {error!r}')
+
+
+    async def request(self, url, send):
+        '''Run coroutine function `send` for `url` within its host's policy.
+
+        Transient failures are tried again with backoff. Other failures, 
+        like a 404, are raised right away.
+        '''
+
+        state = self.host_state(url)
+        policy = state.policy
+
+        for attempt in range(policy.retries + 1):
+            try:
+                state.check()
+            except CircuitOpenError as e:
+                self.record_failure(url, e, attempt)
+                raise
+
+            await state.wait_for_token()
+            try:
+                async with state.semaphore:
+                    if policy.timeout is None:
+                        result = await send()
+                    else:
+                        result = await asyncio.wait_for(send(), policy.timeout)
+            except Exception as e:
+                is_transient = transient(e)
+                # the host answered if the failure isn't transient
+                state.record(not is_transient)
+                if (not is_transient) or (attempt == policy.retries):
+                    if is_transient:
+                        self.record_failure(url, e, attempt + 1)
+                    raise
+                delay = min(policy.max_backoff, policy.backoff*2**attempt)*random.uniform(0.5, 1)
+                logger_transport.info(f'retrying {url} in {delay:.1f} s after {e!r}')
+                await asyncio.sleep(delay)
+            else:
+                state.record(True)
+                return result
+
+
+    async def fetch(self, url, response='text', headers=None, cache=False):
+        '''Request `url` and return the body.
+
+        `response` can be "text", "json", or "bytes". With `cache`, the 
+        response is stored in `http_cache` and revalidated next time. 
+        This is meant for metadata, like search results, not data.
+
+        A url that is already being requested the same way isn't requested
+        again; both callers get the same response.
+        '''
+
+        key = (url, response, cache, tuple(sorted((headers or {}).items())))
+        task = self._in_flight.get(key)
+        if task is None:
+            if cache and (self.http_cache is not None):
+                send = lambda: self.fetch_cached(url, response=response, headers=headers)
+            else:
+                send = lambda: self.fetch_once(url, response=response, headers=headers)
+            task = asyncio.ensure_future(self.request(url, send))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._in_flight.pop(key, None))
+
+        # one caller giving up doesn't cancel the request for the others
+        return await asyncio.shield(task)
+
+
+    async def fetch_once(self, url, response='text', headers=None):
+        '''Request `url` once without the host's policy.'''
+
+        session = await self.session()
+        async with session.get(url, headers=headers) as resp:
+            resp.raise_for_status()
+            if response == 'json':
+                return await resp.json(content_type=None)
+            elif response == 'bytes':
+                return await resp.read()
+            else:
+                return await resp.text()
+
+
+    async def fetch_cached(self, url, response='text', headers=None):
+        '''Request `url` with the validators of its stored response.'''
+
+        # reading and writing the cache is done off the loop so other 
+        # requests aren't held up by the disk
+        loop = asyncio.get_running_loop()
+        key = self.http_cache.key(url, headers)
+        body, info = await loop.run_in_executor(None, self.http_cache.get, key)
+
+        request_headers = dict(headers or {})
+        if body is not None:
+            if info.get('etag'):
+                request_headers['If-None-Match'] = info['etag']
+            if info.get('last_modified'):
+                request_headers['If-Modified-Since'] = info['last_modified']
+
+        session = await self.session()
+        async with session.get(url, headers=request_headers) as resp:
+            if (resp.status == 304) and (body is not None):
+                await loop.run_in_executor(None, self.http_cache.touch, key)
+                return decode(body, response, info.get('encoding'))
+            resp.raise_for_status()
+            body = await resp.read()
+            info = {'url': url, 'etag': resp.headers.get('ETag'), 
+                    'last_modified': resp.headers.get('Last-Modified'),
+                    'encoding': resp.get_encoding() if response != 'bytes' else None}
+
+        # responses without validators can't be revalidated
+        if info['etag'] or info['last_modified']:
+            await loop.run_in_executor(None, self.http_cache.set, key, body, info)
+
+        return decode(body, response, info['encoding'])
+
+
+    async def fetch_if_changed(self, url, validators=None, response='bytes'):
+        '''Request `url` unless it hasn't changed since it was last read.
+
+        `validators` are the ETag and Last-Modified headers from when it
+        was last read. Returns the body, or None if it hasn't changed, and 
+        the new validators.
+        '''
+
+        return await self.request(url, lambda: self.fetch_if_changed_once(url, validators, response))
+
+
+    async def fetch_if_changed_once(self, url, validators=None, response='bytes'):
+
+        validators = validators or {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        session = await self.session()
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return None, validators
+            resp.raise_for_status()
+            if response == 'text':
+                body = await resp.text()
+            else:
+                body = await resp.read()
+            return body, {'etag': resp.headers.get('ETag'), 
+                          'last_modified': resp.headers.get('Last-Modified')}
+
+
+    async def fetch_many(self, urls, response='text', headers=None, cache=False):
+        '''Request all `urls` at once, returning exceptions in place.'''
+
+        tasks = [self.fetch(url, response=response, headers=headers, cache=cache) for url in urls]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    async def fetch_many_if_changed(self, urls, validators, response='bytes'):
+        '''`fetch_if_changed` for all `urls` at once, returning exceptions in place.'''
+
+        tasks = [self.fetch_if_changed(url, validators=url_validators, response=response) 
+                 for url, url_validators in zip(urls, validators)]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    def run(self, coro):
+        '''Run coroutine `coro` on the background loop and wait for it.'''
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+    def get(self, url, response='text', headers=None, cache=False):
+        '''Blocking request for one url. Raises on failure.'''
+
+        return self.run(self.fetch(url, response=response, headers=headers, cache=cache))
+
+
+    def get_if_changed(self, url, validators=None, response='bytes'):
+        '''Blocking `fetch_if_changed`. Raises on failure.'''
+
+        return self.run(self.fetch_if_changed(url, validators=validators, response=response))
+
+
+    def get_many_if_changed(self, urls, validators, response='bytes'):
+        '''Blocking `fetch_many_if_changed` with a dict of validators for each url.'''
+
+        urls = list(urls)
+        if len(urls) == 0:
+            return []
+
+        return self.run(self.fetch_many_if_changed(urls, validators, response=response))
+
+
+    def get_many(self, urls, response='text', headers=None, cache=False):
+        '''Blocking request for many urls, all in flight at once.
+
+        Returns a list in the order of `urls`. A url that failed has its
+        exception in the list instead of the body so the caller can
+        decide what to do with it.
+        '''
+
+        urls = list(urls)
+        if len(urls) == 0:
+            return []
+
+        return self.run(self.fetch_many(urls, response=response, headers=headers, cache=cache))
+
+
+    def close(self):
+        '''Close the shared session. It will be reopened if used again.'''
+
+        if (self._session is not None) and (not self._session.closed):
+            self.run(self._session.close())
+
+
+# shared by all readers
+transport = Transport(http_cache=HTTPCache())
+
+
+def not_found(error):
+    '''Whether `error` is a 404 response.
+    
+    ERDDAP responds with 404 when a query has no matching results.
+    '''
+    
+    return isinstance(error, aiohttp.ClientResponseError) and (error.status == 404)
+
+
+def read_csv_text(text, **kwargs):
+    '''Parse `text` from a response with `pd.read_csv`.'''
+
+    return pd.read_csv(io.StringIO(text), **kwargs)
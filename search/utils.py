@@ -0,0 +1,591 @@
+'''Helper functions used by the readers that don't need the network.'''
+
+import re
+import io
+import csv
+import urllib.parse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+try:
+    from pyarrow import csv as pa_csv
+    from pyarrow import ArrowInvalid
+except ImportError:
+    pa_csv = None
+    ArrowInvalid = ()
+
+
+# ERDDAP data types that are converted to numbers in metadata
+FLOAT_TYPES = ['double', 'float']
+INT_TYPES = ['int', 'short', 'long', 'byte']
+
+
+def _fill_and_convert(values, dtypes):
+    '''Fill in missing attributes and convert numeric ones.
+
+    `values` and `dtypes` are DataFrames of attribute values and ERDDAP
+    data types with a row per dataset and a column per attribute.
+    '''
+
+    missing = dtypes.isnull()
+
+    # convert a column at a time instead of a value at a time
+    values = values.astype(object)
+    for col in values.columns:
+        for types, dtype in [(FLOAT_TYPES, 'float64'), (INT_TYPES, 'int64')]:
+            rows = dtypes[col].isin(types)
+            if rows.any():
+                values.loc[rows, col] = values.loc[rows, col].astype(dtype).values
+
+    # featureType is not present in HF Radar metadata but want it to
+    # map to data_type, so input 'grid' in that case.
+    values = values.mask(missing, 'NA')
+    if 'featureType' in values.columns:
+        values.loc[missing['featureType'], 'featureType'] = 'grid'
+
+    return values
+
+
+def parse_info(info, columns):
+    '''Values of attributes `columns` from one ERDDAP info csv.
+
+    Parameters
+    ----------
+    info: DataFrame
+        Info csv for a dataset from `{server}/info/{dataset_id}/index.csv`.
+    columns: list
+        Attribute names to return. The first row with each name is used.
+
+    Returns
+    -------
+    List of values in the order of `columns`. Missing attributes are "NA",
+    except for featureType which is "grid".
+    '''
+
+    attrs = info.drop_duplicates('Attribute Name').set_index('Attribute Name')
+    attrs = attrs.reindex(columns)
+
+    items = []
+    for col, value, dtype in zip(columns, attrs['Value'], attrs['Data Type']):
+        if pd.isnull(dtype):
+            # see _fill_and_convert
+            item = 'grid' if col == 'featureType' else 'NA'
+        elif dtype in FLOAT_TYPES:
+            item = float(value)
+        elif dtype in INT_TYPES:
+            item = int(value)
+        else:
+            item = value
+        items.append(item)
+
+    return items
+
+
+def parse_infos(infos, columns):
+    '''Metadata DataFrame from many ERDDAP info csvs at once.
+
+    Parameters
+    ----------
+    infos: dict
+        Info csv DataFrame for each dataset_id.
+    columns: list
+        Attribute names to return. The first row with each name is used.
+
+    Returns
+    -------
+    DataFrame with a row per dataset_id and a column per attribute,
+    matching `parse_info` for each dataset.
+    '''
+
+    if len(infos) == 0:
+        return pd.DataFrame(columns=columns)
+
+    info = pd.concat(infos, names=['dataset_id', None]).reset_index(level=0)
+    info = info[info['Attribute Name'].isin(columns)]
+    info = info.drop_duplicates(['dataset_id', 'Attribute Name'])
+
+    values = info.pivot(index='dataset_id', columns='Attribute Name', values='Value')
+    dtypes = info.pivot(index='dataset_id', columns='Attribute Name', values='Data Type')
+
+    index = list(infos.keys())
+    values = values.reindex(index=index, columns=columns)
+    dtypes = dtypes.reindex(index=index, columns=columns)
+
+    values = _fill_and_convert(values, dtypes)
+    values.index.name = None
+    values.columns.name = None
+
+    return values
+
+
+def parse_chunk_size(size):
+    '''Interpret the size of time chunks for a download.
+
+    Parameters
+    ----------
+    size: int, str, or pd.Timedelta
+        An int is a target number of rows. A string like "20MB" is a 
+        target number of bytes. Any other string or Timedelta is the 
+        length of time of each chunk, like "30D".
+
+    Returns
+    -------
+    Tuple of ("rows", int), ("bytes", float), or ("time", pd.Timedelta).
+    '''
+
+    if isinstance(size, (int, float)) and not isinstance(size, bool):
+        return ('rows', int(size))
+
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kKMG]?)B\s*', str(size))
+    if match is not None:
+        number, prefix = match.groups()
+        factor = {'': 1, 'k': 1e3, 'K': 1e3, 'M': 1e6, 'G': 1e9}[prefix]
+        return ('bytes', float(number)*factor)
+
+    return ('time', pd.Timedelta(size))
+
+
+def time_windows(min_time, max_time, freq):
+    '''Split the time range into windows of length `freq`.
+
+    Returns a list of (start, end) Timestamps. Windows share their end and
+    start times so they are meant to be used as [start, end) except for 
+    the last, which ends at `max_time`.
+    '''
+
+    min_time, max_time = pd.Timestamp(min_time), pd.Timestamp(max_time)
+    freq = pd.Timedelta(freq)
+    assert freq > pd.Timedelta(0), '`freq` must be positive'
+
+    starts = []
+    start = min_time
+    while start < max_time:
+        starts.append(start)
+        start = start + freq
+
+    if len(starts) == 0:
+        return [(min_time, max_time)]
+
+    ends = starts[1:] + [max_time]
+    return list(zip(starts, ends))
+
+
+def spatial_constraints(kw, lon_range=None):
+    '''Tabledap constraints for the lon/lat box in `kw`.
+
+    Parameters
+    ----------
+    kw: dict
+        Search box with min_lon, max_lon, min_lat, max_lat.
+    lon_range: tuple
+        (min, max) longitude of the dataset. If the dataset uses 0 to 360
+        longitudes, the box is shifted to match.
+
+    Returns
+    -------
+    Dict of constraints. Longitude is left out if the box crosses the 
+    dataset's longitude seam so the data has to be clipped locally.
+    '''
+
+    constraints = {}
+    if ('min_lat' in kw) and ('max_lat' in kw):
+        constraints['latitude>='] = kw['min_lat']
+        constraints['latitude<='] = kw['max_lat']
+
+    if ('min_lon' in kw) and ('max_lon' in kw):
+        min_lon, max_lon = kw['min_lon'], kw['max_lon']
+        if (lon_range is not None) and (lon_range[1] > 180):
+            min_lon, max_lon = min_lon % 360, max_lon % 360
+        if min_lon <= max_lon:
+            constraints['longitude>='] = min_lon
+            constraints['longitude<='] = max_lon
+
+    return constraints
+
+
+def clip_to_box(df, kw):
+    '''Rows of `df` inside the lon/lat box in `kw`.
+
+    Latitude and longitude columns are found by name, with or without 
+    units like "latitude (degrees_north)". Rows without a position are
+    kept.
+    '''
+
+    names = {col.split(' (')[0]: col for col in df.columns}
+    mask = np.ones(len(df), dtype=bool)
+
+    if ('latitude' in names) and ('min_lat' in kw) and ('max_lat' in kw):
+        lat = df[names['latitude']].to_numpy(dtype=float)
+        mask &= ((lat >= kw['min_lat']) & (lat <= kw['max_lat'])) | np.isnan(lat)
+
+    if ('longitude' in names) and ('min_lon' in kw) and ('max_lon' in kw):
+        lon = df[names['longitude']].to_numpy(dtype=float)
+        # compare in -180 to 180 in case data are 0 to 360
+        lon = np.where(lon > 180, lon - 360, lon)
+        mask &= ((lon >= kw['min_lon']) & (lon <= kw['max_lon'])) | np.isnan(lon)
+
+    return df[mask]
+
+
+def _like_csvp(df, units):
+    '''Match a decoded tabledap table to what reading csvp gives.
+
+    Columns are named like "name (units)", times are UTC, strings are 
+    str, and the first column is the index.
+    '''
+
+    names = {}
+    for col in df.columns:
+        unit = units.get(col, '')
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.tz_localize('UTC') if df[col].dt.tz is None else df[col].dt.tz_convert('UTC')
+            unit = 'UTC'
+        elif unit.startswith('seconds since 1970-01-01'):
+            df[col] = pd.to_datetime(df[col], unit='s', utc=True)
+            unit = 'UTC'
+        elif df[col].dtype == object:
+            df[col] = [value.decode() if isinstance(value, bytes) else value for value in df[col]]
+        names[col] = f'{col} ({unit})' if unit else col
+
+    df = df.rename(columns=names)
+    return df.set_index(df.columns[0])
+
+
+def frame_from_nc(content):
+    '''DataFrame from the bytes of a tabledap .nc response.
+
+    Values are already typed so only the names need to match csvp.
+    '''
+
+    with xr.open_dataset(io.BytesIO(content)) as ds:
+        units = {name: var.attrs.get('units', '') for name, var in ds.variables.items()}
+        df = ds.to_dataframe().reset_index(drop=True)
+
+    return _like_csvp(df, units)
+
+
+def frame_from_parquet(content, units):
+    '''DataFrame from the bytes of a tabledap .parquet response.
+
+    Parquet doesn't have the units so they are input as a dict of units 
+    per variable name.
+    '''
+
+    return _like_csvp(pd.read_parquet(io.BytesIO(content)), units)
+
+
+def utc_timestamp(time):
+    '''`time` as a UTC Timestamp. Times without a time zone are UTC.'''
+
+    time = pd.Timestamp(time)
+    return time.tz_localize('UTC') if time.tz is None else time.tz_convert('UTC')
+
+
+def utc_end(time):
+    '''`time` as a UTC Timestamp at the end of the period it is given to.
+
+    A string only given to the day, like "2020-8-2", is the end of that 
+    day, like when slicing a DatetimeIndex by label, instead of midnight 
+    at its start. Other times are used as they are.
+    '''
+
+    end = utc_timestamp(time)
+    if isinstance(time, str):
+        try:
+            period = pd.Period(time)
+        except ValueError:
+            # like "now"
+            return end
+        end = end + (period.end_time - period.start_time)
+    return end
+
+
+def empty_frame(time_col='time'):
+    '''DataFrame without rows indexed by UTC time, for no data in a window.'''
+
+    return pd.DataFrame(index=pd.DatetimeIndex([], tz='UTC', name=time_col))
+
+
+def _arrow_blocks(f, block_size):
+    '''DataFrames of blocks of csv `f` parsed with pyarrow on several threads.'''
+
+    read_options = pa_csv.ReadOptions(block_size=block_size, use_threads=True)
+    for batch in pa_csv.open_csv(f, read_options=read_options):
+        yield batch.to_pandas()
+
+
+def _pandas_blocks(f, block_size):
+    '''DataFrames of blocks of csv `f` parsed with pandas.'''
+
+    # about 100 bytes a row
+    for chunk in pd.read_csv(f, chunksize=max(1, block_size//100)):
+        yield chunk
+
+
+def read_csv_window(f, start=None, end=None, columns=None, time_col='time', 
+                    block_size=1 << 24, engine=None):
+    '''Rows of csv `f` with `time_col` from `start` to `end`, read in blocks.
+
+    Rows outside of the time window are dropped as each block is read, 
+    and once the times have been increasing, reading stops at the first 
+    block after `end`.
+
+    Parameters
+    ----------
+    f: file-like
+        Binary, uncompressed csv to read from as it streams.
+    start, end: str, Timestamp, or None
+        Time window to keep. Times without a time zone are UTC. An `end` 
+        given only to the day includes all of that day.
+    columns: list or None
+        Columns to keep besides `time_col`. None keeps all of them.
+    time_col: str
+        Name of the time column.
+    block_size: int
+        Number of bytes to parse at once.
+    engine: str or None
+        "pyarrow" parses each block on several threads, "pandas" with 
+        `pd.read_csv`. None uses pyarrow if it is installed. If pyarrow 
+        can't convert a later block to the types found in the first, `f` 
+        is read again with pandas if it can be.
+
+    Returns
+    -------
+    DataFrame indexed by UTC time.
+    '''
+
+    if engine is None:
+        engine = 'pandas' if pa_csv is None else 'pyarrow'
+
+    start = None if start is None else utc_timestamp(start)
+    end = None if end is None else utc_end(end)
+    position = f.tell() if f.seekable() else None
+
+    blocks = _arrow_blocks(f, block_size) if engine == 'pyarrow' else _pandas_blocks(f, block_size)
+    frames = []
+    increasing, last = True, None
+    try:
+        for block in blocks:
+            if columns is not None:
+                block = block[[time_col] + [col for col in block.columns 
+                                            if (col in columns) and (col != time_col)]]
+            times = pd.DatetimeIndex(pd.to_datetime(block[time_col], utc=True))
+            if len(times) == 0:
+                continue
+            
+            increasing = increasing and times.is_monotonic_increasing and ((last is None) or (times[0] >= last))
+            last = times[-1]
+            
+            mask = np.ones(len(times), dtype=bool)
+            if start is not None:
+                mask &= times >= start
+            if end is not None:
+                mask &= times <= end
+            frames.append(block.set_axis(times, axis='index')[mask])
+            
+            if increasing and (end is not None) and (last > end):
+                break
+    except ArrowInvalid:
+        if position is None:
+            raise
+        f.seek(position)
+        return read_csv_window(f, start, end, columns, time_col, block_size, engine='pandas')
+    
+    if len(frames) == 0:
+        return empty_frame(time_col)
+
+    return pd.concat(frames).drop(columns=time_col).rename_axis(time_col)
+
+
+def time_key(ds):
+    '''Name of the time coordinate of `ds`, by standard_name or else by name.'''
+
+    timekey = [coord for coord in ds.coords if ds[coord].attrs.get('standard_name') == 'time']
+    if len(timekey) == 0:
+        timekey = [coord for coord in ds.coords if ('time' in coord) or (coord == 't')]
+    assert len(timekey) > 0, 'no time coordinate found'
+
+    return timekey[0]
+
+
+def time_indexer(times, start, end):
+    '''Positions of `times` from `start` to `end`, in time order without repeats.
+
+    `times` are the values of a time coordinate, in UTC. If they are 
+    already in order, which is checked in one pass, the window is found by
+    binary search and only times inside it are checked for repeats. 
+    Returns a slice when nothing in the window repeats so that the data 
+    can be read in as one block. An `end` given only to the day includes 
+    all of that day, like `.sel` with a slice.
+    '''
+
+    times = np.asarray(times)
+    start = utc_timestamp(start).tz_localize(None).to_datetime64()
+    end = utc_end(end).tz_localize(None).to_datetime64()
+
+    if (len(times) < 2) or (times[1:] >= times[:-1]).all():
+        i0, i1 = np.searchsorted(times, start, 'left'), np.searchsorted(times, end, 'right')
+        window = times[i0:i1]
+        repeats = np.zeros(len(window), dtype=bool)
+        repeats[1:] = window[1:] == window[:-1]
+        if not repeats.any():
+            return slice(int(i0), int(i1))
+        return i0 + np.flatnonzero(~repeats)
+
+    # out of order: the first of each time in the window, sorted
+    positions = np.flatnonzero((times >= start) & (times <= end))
+    _, first = np.unique(times[positions], return_index=True)
+    index = positions[first]
+    if (len(index) > 0) and (np.diff(index) == 1).all():
+        return slice(int(index[0]), int(index[-1]) + 1)
+    return index
+
+
+def _clamp(start, stop, actual_range):
+    '''Limit (start, stop) to `actual_range`, or None if they don't overlap.'''
+
+    start, stop = max(start, actual_range[0]), min(stop, actual_range[1])
+    return None if start > stop else (start, stop)
+
+
+def griddap_query(info, kw, variables=None, stride=1):
+    '''Query for the hyperslab of a griddap dataset within `kw`.
+
+    Parameters
+    ----------
+    info: DataFrame
+        Info csv for the dataset, which has its dimensions and their 
+        actual_range.
+    kw: dict
+        Time range and lon/lat box. Dimensions that aren't in `kw`, like
+        depth, are requested in full.
+    variables: list
+        Names of variables to request. All data variables are requested
+        if this is None or none of them are in the dataset.
+    stride: int or dict
+        Take every `stride` value along each dimension, or a stride for 
+        each dimension name.
+
+    Returns
+    -------
+    Query string for a `.nc` griddap url, or None if the dataset isn't in
+    `kw` or doesn't list its dimensions.
+    '''
+
+    dims = info.loc[info['Row Type'] == 'dimension', 'Variable Name'].tolist()
+    data_vars = info.loc[info['Row Type'] == 'variable', 'Variable Name'].tolist()
+    if (len(dims) == 0) or (len(data_vars) == 0):
+        return None
+
+    if variables is not None and any(var in data_vars for var in variables):
+        data_vars = [var for var in data_vars if var in variables]
+
+    ranges = info[info['Attribute Name'] == 'actual_range'].drop_duplicates('Variable Name')
+    ranges = dict(zip(ranges['Variable Name'], ranges['Value']))
+
+    constraints = ''
+    for dim in dims:
+        step = stride.get(dim, 1) if isinstance(stride, dict) else stride
+        # full dimension unless narrowed below
+        constraint = f'[0:{step}:last]'
+
+        if dim in ranges:
+            actual_range = [float(value) for value in ranges[dim].split(',')]
+
+            if (dim == 'time') and ('min_time' in kw) and ('max_time' in kw):
+                # info has times in seconds since 1970
+                actual_range = pd.to_datetime(actual_range, unit='s', utc=True)
+                limits = _clamp(utc_timestamp(kw['min_time']), utc_timestamp(kw['max_time']), actual_range)
+                if limits is None:
+                    return None
+                start, stop = [limit.strftime('%Y-%m-%dT%H:%M:%SZ') for limit in limits]
+                constraint = f'[({start}):{step}:({stop})]'
+
+            elif (dim == 'latitude') and ('min_lat' in kw) and ('max_lat' in kw):
+                limits = _clamp(kw['min_lat'], kw['max_lat'], actual_range)
+                if limits is None:
+                    return None
+                constraint = f'[({limits[0]}):{step}:({limits[1]})]'
+
+            elif (dim == 'longitude') and ('min_lon' in kw) and ('max_lon' in kw):
+                min_lon, max_lon = kw['min_lon'], kw['max_lon']
+                if actual_range[1] > 180:
+                    min_lon, max_lon = min_lon % 360, max_lon % 360
+                # a box across the dataset's longitude seam gets all longitudes
+                if min_lon <= max_lon:
+                    limits = _clamp(min_lon, max_lon, actual_range)
+                    if limits is None:
+                        return None
+                    constraint = f'[({limits[0]}):{step}:({limits[1]})]'
+
+        constraints += constraint
+
+    query = ','.join([f'{var}{constraints}' for var in data_vars])
+    return urllib.parse.quote(query, safe=',:()')
+
+
+def count_rows(text):
+    '''Number of rows after the header in csv `text`.
+
+    Quoted fields can have newlines, like dataset summaries, so this 
+    splits records instead of lines but doesn't build a DataFrame.
+    '''
+
+    return max(sum(1 for row in csv.reader(io.StringIO(text)) if row) - 1, 0)
+
+
+def merge_intervals(intervals):
+    '''Sorted intervals that don't overlap, covering the same times as `intervals`.'''
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and (start <= merged[-1][1]):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def missing_intervals(covered, start, end):
+    '''Parts of the interval from `start` to `end` that aren't in `covered`.
+
+    Returns a list of (start, end), which is empty if the interval is 
+    covered.
+    '''
+
+    missing = []
+    for covered_start, covered_end in merge_intervals(covered):
+        if covered_end < start:
+            continue
+        if covered_start > end:
+            break
+        if covered_start > start:
+            missing.append((start, covered_start))
+        start = covered_end
+        if start >= end:
+            return missing
+
+    missing.append((start, end))
+    return missing
+
+
+def griddap_time_url(url, start, end):
+    '''Griddap `url` from `griddap_query` with its times narrowed to `start`-`end`.
+
+    Returns None if they don't overlap the times in `url`.
+    '''
+
+    pattern = r'\((\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)\):(\d+):\((\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)\)'
+    match = re.search(pattern, url)
+    if match is None:
+        return url
+
+    limits = _clamp(utc_timestamp(start), utc_timestamp(end), 
+                    (utc_timestamp(match[1]), utc_timestamp(match[3])))
+    if limits is None:
+        return None
+
+    start, end = [limit.strftime('%Y-%m-%dT%H:%M:%SZ') for limit in limits]
+    return re.sub(pattern, lambda match: f'({start}):{match[2]}:({end})', url)
@@ -0,0 +1,269 @@
+'''Local index of the variables available on each server.'''
+
+import os
+import re
+import gzip
+import heapq
+import threading
+import contextlib
+from collections import Counter, defaultdict
+import pandas as pd
+from search.cache import write_atomic
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows
+    fcntl = None
+
+
+class VariableStore:
+    '''Number of datasets with each variable on a server, stored on disk.
+
+    The store is a gzipped csv with a row per variable that has its count
+    and when that count was refreshed, in seconds since 1970, and 
+    optionally the ETag and Last-Modified of the response it was counted 
+    from. The file's mtime is when the list of variables was last 
+    refreshed. Reads are kept
+    in memory so repeated lookups don't touch the disk.
+
+    Parameters
+    ----------
+    name: str
+        Name of the server, like "erddap_ioos".
+    cache_dir: str
+        Directory to store the index in.
+    '''
+
+    # (mtime, DataFrame) for each path, shared in the process
+    _memory = {}
+    _lock = threading.Lock()
+
+    def __init__(self, name, cache_dir=os.path.join('..', 'cache', 'variables')):
+
+        self.name = name
+        self.path = os.path.join(cache_dir, f'{name}.csv.gz')
+
+
+    @property
+    def refreshed(self):
+        '''When the store was last written, or None if it doesn't exist.'''
+
+        return os.path.getmtime(self.path) if os.path.exists(self.path) else None
+
+
+    def load(self):
+        '''DataFrame indexed by variable with columns count and refreshed.
+
+        Returns None if there is no store yet.
+        '''
+
+        mtime = self.refreshed
+        if mtime is None:
+            return None
+
+        with VariableStore._lock:
+            cached = VariableStore._memory.get(self.path)
+            if (cached is None) or (cached[0] != mtime):
+                cached = (mtime, pd.read_csv(self.path, index_col='variable'))
+                VariableStore._memory[self.path] = cached
+
+        return cached[1]
+
+
+    def save(self, variables):
+        '''Write `variables`, with columns count and refreshed, to the store.'''
+
+        columns = [col for col in ['count', 'refreshed', 'etag', 'last_modified'] if col in variables]
+        variables = variables[columns].rename_axis('variable')
+        write_atomic(self.path, gzip.compress(variables.to_csv().encode()))
+
+        with VariableStore._lock:
+            VariableStore._memory.pop(self.path, None)
+
+
+    @contextlib.contextmanager
+    def lock(self):
+        '''Hold the store while refreshing it, across threads and processes.
+
+        Whoever waited for the lock should load the store again, since it 
+        may have just been refreshed.
+        '''
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    @staticmethod
+    def validators(variables):
+        '''Dict of the stored ETag and Last-Modified for each row of `variables`.'''
+
+        columns = [col for col in ['etag', 'last_modified'] if col in variables]
+        rows = variables[columns].astype(object).where(variables[columns].notnull(), None)
+        return [dict(zip(columns, row)) for row in rows.itertuples(index=False)]
+
+
+    def stale(self, variables, max_age, now):
+        '''Whether each of `variables` was refreshed at least `max_age` seconds before `now`.'''
+
+        return variables['refreshed'].isnull() | (now - variables['refreshed'] >= max_age)
+
+
+def trigrams(text):
+    '''Set of 3-character substrings of `text`.'''
+
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+class VariableIndex:
+    '''Trigram index of variable names from one or more servers.
+
+    Names are looked up by the trigrams they share with a query instead of
+    checking a regular expression against every name.
+
+    Parameters
+    ----------
+    counts: dict
+        DataFrame of counts for each server name, like from 
+        `all_variables()`.
+    '''
+
+    def __init__(self, counts):
+
+        table = pd.concat({name: df['count'] for name, df in counts.items()}, axis=1)
+        table = table.fillna(0).astype(int)
+        table.insert(0, 'count', table.sum(axis=1))
+        self.table = table.rename_axis('variable')
+
+        self.names = [str(name).lower() for name in self.table.index]
+        self.totals = self.table['count'].to_numpy()
+
+        postings = defaultdict(set)
+        for i, name in enumerate(self.names):
+            for gram in trigrams(name):
+                postings[gram].add(i)
+        self.postings = dict(postings)
+
+
+    def substring(self, query, regex=True):
+        '''Positions of names that contain `query` or match it as a regular expression.'''
+
+        # keep supporting searches like "sea.*temp"
+        if regex and re.search(r'[.*+?^$()\[\]{}|\\]', query):
+            try:
+                r = re.compile(query, re.IGNORECASE)
+                return {i for i, name in enumerate(self.names) if r.search(name)}
+            except re.error:
+                pass
+
+        query = query.lower()
+        grams = sorted(trigrams(query), key=lambda gram: len(self.postings.get(gram, ())))
+        if len(grams) == 0:
+            candidates = range(len(self.names))
+        else:
+            candidates = set(self.postings.get(grams[0], set()))
+            for gram in grams[1:]:
+                candidates &= self.postings.get(gram, set())
+
+        return {i for i in candidates if query in self.names[i]}
+
+
+    def similar(self, query, min_similarity=0.5):
+        '''Similarity to `query` of names that share enough of its trigrams.'''
+
+        grams = trigrams(query.lower())
+        if len(grams) == 0:
+            return {}
+
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+
+        return {i: n/len(grams) for i, n in shared.items() if n/len(grams) >= min_similarity}
+
+
+    def search(self, variables, fuzzy=False, limit=None):
+        '''Variables matching any of `variables`, most common first.
+
+        Parameters
+        ----------
+        variables: str or list
+            Substrings or regular expressions, case-insensitive.
+        fuzzy: bool
+            Also return names that are close to a query, like with typos, 
+            after the exact matches.
+        limit: int
+            Return at most this many.
+
+        Returns
+        -------
+        DataFrame of the total count and count per server of each match.
+        '''
+
+        if not isinstance(variables, list):
+            variables = [variables]
+
+        matches = set()
+        for variable in variables:
+            matches |= self.substring(variable)
+        ranked = sorted(matches, key=lambda i: -self.totals[i])
+
+        if fuzzy:
+            scores = Counter()
+            for variable in variables:
+                for i, score in self.similar(variable).items():
+                    if i not in matches:
+                        scores[i] = max(scores[i], score)
+            ranked += sorted(scores, key=lambda i: (-scores[i], -self.totals[i]))
+
+        return self.table.iloc[ranked[:limit]]
+
+
+    def complete(self, prefix, limit=10):
+        '''Names for autocompleting `prefix`, ones that start with it first.'''
+
+        prefix = prefix.lower()
+        matches = self.substring(prefix, regex=False)
+        ranked = heapq.nsmallest(limit, matches, 
+                                 key=lambda i: (not self.names[i].startswith(prefix), -self.totals[i]))
+
+        return list(self.table.index[ranked])
+
+
+# indexes built in this process by key
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(key, counts):
+    '''VariableIndex for `key`, built once per process.
+
+    `counts` is a function that returns the counts for `VariableIndex` 
+    and is only called the first time. It is called without the lock 
+    held since refreshing counts calls `reset_indexes`.
+    '''
+
+    with _indexes_lock:
+        index = _indexes.get(key)
+
+    if index is None:
+        index = VariableIndex(counts())
+        with _indexes_lock:
+            # keep the index of whoever finished first
+            index = _indexes.setdefault(key, index)
+
+    return index
+
+
+def reset_indexes():
+    '''Forget built indexes so they are built again from new counts.'''
+
+    with _indexes_lock:
+        _indexes.clear()